@@ -0,0 +1,369 @@
+#!/usr/bin/env python3
+"""
+Benchmark Offline do Atualizador e da Análise de Valuation
+
+Mede, sem acesso à rede e sem depender dos ZIPs em CVM_DATA:
+1. Vazão do update_data.py (processamento completo e reexecução incremental) sobre ZIPs
+   DFP sintéticos com o layout da CVM, de tamanho configurável.
+2. carregar_dados_preparados a frio (sem lru_cache) e a quente.
+3. Latência por ticker do valuation (caminho escalar) e o tempo do caminho vetorizado.
+4. /run_analysis de ponta a ponta: a frio (sem snapshot e sem cache externo) e a quente
+   (servindo o snapshot).
+
+yfinance e a API do BCB são substituídos por um stub local que gera cotações, preços e
+séries sintéticas determinísticas (com latência opcional). Com --respostas-gravadas, um
+arquivo de cache (dados_externos.sqlite3) de uma execução real é usado como fonte das
+respostas gravadas; o que não estiver gravado cai no stub.
+
+As chamadas ao stub passam pelo mesmo cliente HTTP da aplicação, com os limites por host do
+CONFIG na parcela de um worker entre --processos (padrão: HTTP_PROCESSOS); assim o /run_analysis
+a frio inclui a espera pelo limite de taxa que uma execução real teria. --sem-limite-taxa mede
+só o processamento.
+
+Tudo roda num diretório temporário; o resultado vai para um JSON (--saida) que pode ser
+comparado entre versões.
+
+Uso: python benchmark.py [--empresas N] [--anos N] [--repeticoes N] [--workers N]
+                         [--latencia-ms MS] [--processos N] [--sem-limite-taxa]
+                         [--respostas-gravadas ARQUIVO] [--saida ARQUIVO]
+"""
+import argparse
+import contextlib
+import io
+import json
+import logging
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import zipfile
+import zlib
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+import flask_app
+import update_data
+from cache_dados import CacheDisco
+from cliente_http import ClienteHTTP
+
+BASE_DIR = Path(__file__).resolve().parent
+
+# Contas geradas nos ZIPs sintéticos (as usadas pelo valuation e algumas a mais, como na CVM)
+CONTAS_SINTETICAS = {
+    "DRE": ["3.01", "3.02", "3.03", "3.05", "3.06", "3.07", "3.08", "3.09", "3.10", "3.11"],
+    "BPA": ["1", "1.01", "1.01.01", "1.01.02", "1.01.03", "1.01.04", "1.02", "1.02.01"],
+    "BPP": ["2", "2.01", "2.01.02", "2.01.04", "2.02", "2.02.01", "2.03"],
+    "DFC_MI": ["6.01", "6.02", "6.03", "6.05"],
+}
+COLUNAS_CSV_CVM = ["CNPJ_CIA", "DT_REFER", "VERSAO", "DENOM_CIA", "CD_CVM", "GRUPO_DFP", "MOEDA",
+                   "ESCALA_MOEDA", "ORDEM_EXERC", "DT_FIM_EXERC", "CD_CONTA", "DS_CONTA", "VL_CONTA",
+                   "ST_CONTA_FIXA"]
+
+# --- Dados Sintéticos ---
+
+def _semente(texto):
+    return zlib.crc32(str(texto).encode())
+
+def gerar_zips_dfp(diretorio, anos, codigos, empresas_extras=0, seed=0):
+    """
+    Grava um dfp_cia_aberta_<ano>.zip por ano com os CSVs con/ind de cada tipo.
+    `empresas_extras` acrescenta empresas fora do mapeamento (descartadas pelo filtro de CD_CVM).
+    Retorna o tamanho total dos ZIPs em bytes.
+    """
+    rng = np.random.default_rng(seed)
+    todos_codigos = list(codigos) + [max(codigos) + 1 + i for i in range(empresas_extras)]
+    total_bytes = 0
+    for ano in anos:
+        caminho_zip = diretorio / f"dfp_cia_aberta_{ano}.zip"
+        with zipfile.ZipFile(caminho_zip, "w", zipfile.ZIP_DEFLATED) as z:
+            for tipo, contas in CONTAS_SINTETICAS.items():
+                for escopo in ("con", "ind"):
+                    # Como na CVM, parte das empresas só publica o demonstrativo individual
+                    codigos_escopo = [c for c in todos_codigos if escopo == "ind" or c % 4 != 0]
+                    n = len(codigos_escopo) * len(contas) * 2
+                    cd_cvm = np.repeat(codigos_escopo, len(contas) * 2)
+                    valores = rng.normal(1000, 400, n).round(2)
+                    df = pd.DataFrame({
+                        "CNPJ_CIA": [f"{c:08d}/0001-00" for c in cd_cvm],
+                        "DT_REFER": f"{ano}-12-31", "VERSAO": 1,
+                        "DENOM_CIA": [f"CIA SINTETICA {c}" for c in cd_cvm],
+                        "CD_CVM": [f"{c:06d}" for c in cd_cvm],
+                        "GRUPO_DFP": f"DF {'Consolidado' if escopo == 'con' else 'Individual'} - {tipo}",
+                        "MOEDA": "REAL", "ESCALA_MOEDA": "MIL",
+                        "ORDEM_EXERC": np.tile(np.repeat(["ÚLTIMO", "PENÚLTIMO"], len(contas)), len(codigos_escopo)),
+                        "DT_FIM_EXERC": f"{ano}-12-31",
+                        "CD_CONTA": np.tile(contas * 2, len(codigos_escopo)),
+                        "DS_CONTA": "Conta sintética", "VL_CONTA": valores, "ST_CONTA_FIXA": "S",
+                    }, columns=COLUNAS_CSV_CVM)
+                    # Despesas (IR e financeiras) são negativas na DRE da CVM
+                    negativas = df["CD_CONTA"].isin(["3.07", "3.08"])
+                    df.loc[negativas, "VL_CONTA"] = -df.loc[negativas, "VL_CONTA"].abs() / 3
+                    conteudo = df.to_csv(sep=";", index=False).encode("latin-1")
+                    z.writestr(f"dfp_cia_aberta_{tipo}_{escopo}_{ano}.csv", conteudo)
+        total_bytes += caminho_zip.stat().st_size
+    return total_bytes
+
+def gerar_mapeamento(caminho, codigos):
+    linhas = ["CD_CVM;Ticker;Nome_Empresa"] + [f"{c};BNCH{c}3;CIA SINTETICA {c}" for c in codigos]
+    caminho.write_text("\n".join(linhas) + "\n", encoding="latin-1")
+
+class StubMercado:
+    """
+    Substitui yfinance (Ticker, download) e requests (get da API do BCB) por respostas
+    sintéticas determinísticas. `latencia` (segundos) é aplicada a cada chamada.
+    """
+    def __init__(self, latencia=0.0, dias=750):
+        self.latencia = latencia
+        self.datas = pd.bdate_range(end="2026-01-02", periods=dias)
+        rng = np.random.default_rng(42)
+        self.retornos_ibov = rng.normal(0.0004, 0.012, dias)
+        self.chamadas = 0
+
+    def _esperar(self):
+        self.chamadas += 1
+        if self.latencia:
+            time.sleep(self.latencia)
+
+    def _serie_precos(self, ticker):
+        if ticker == "^BVSP":
+            return 100_000 * np.cumprod(1 + self.retornos_ibov)
+        rng = np.random.default_rng(_semente(ticker))
+        beta = rng.uniform(0.4, 1.6)
+        retornos = beta * self.retornos_ibov + rng.normal(0, 0.015, len(self.datas))
+        return rng.uniform(5, 80) * np.cumprod(1 + retornos)
+
+    def Ticker(self, ticker):
+        self._esperar()
+        rng = np.random.default_rng(_semente(ticker))
+        preco = float(rng.uniform(5, 80))
+        n_acoes = float(rng.uniform(1e5, 5e6))
+        info = {"currentPrice": preco, "sharesOutstanding": n_acoes,
+                "marketCap": preco * n_acoes, "shortName": f"Sintetica {ticker}"}
+        return type("TickerStub", (), {"info": info})()
+
+    def download(self, tickers, **kwargs):
+        self._esperar()
+        lista = [tickers] if isinstance(tickers, str) else list(tickers)
+        precos = pd.DataFrame({t: self._serie_precos(t) for t in lista}, index=self.datas)
+        return pd.concat({"Adj Close": precos, "Close": precos}, axis=1)
+
+    def get(self, url, timeout=None, **kwargs):
+        self._esperar()
+        valores = {"432": "10.50", "433": "0.44", "1": "5.4321"}
+        codigo = url.split("bcdata.sgs.")[1].split("/")[0]
+        registro = {"data": "01/12/2025", "valor": valores.get(codigo, "1.0")}
+        return type("RespostaStub", (), {"raise_for_status": lambda self: None,
+                                          "json": lambda self: [registro]})()
+
+# --- Medições ---
+
+def resumir_tempos(tempos):
+    ordenados = sorted(tempos)
+    return {
+        "n": len(ordenados), "min": round(ordenados[0], 6), "mediana": round(statistics.median(ordenados), 6),
+        "p95": round(ordenados[min(len(ordenados) - 1, int(0.95 * len(ordenados)))], 6),
+        "max": round(ordenados[-1], 6), "media": round(statistics.fmean(ordenados), 6),
+    }
+
+def cronometrar(funcao, *args, **kwargs):
+    inicio = time.perf_counter()
+    resultado = funcao(*args, **kwargs)
+    return resultado, time.perf_counter() - inicio
+
+def configurar_atualizador(diretorio):
+    update_data.CAMINHO_MAPA_TICKER_CVM = diretorio / "mapeamento_tickers.csv"
+    update_data.DIRETORIO_DADOS_CVM = diretorio / "CVM_DATA"
+    update_data.DIRETORIO_DADOS_CONSOLIDADOS = diretorio / "consolidated_data"
+    update_data.DIRETORIO_PARTICOES = update_data.DIRETORIO_DADOS_CONSOLIDADOS / "particoes"
+    update_data.CAMINHO_MANIFESTO = update_data.DIRETORIO_DADOS_CONSOLIDADOS / "manifesto.json"
+
+def configurar_aplicacao(diretorio, stub, respostas_gravadas=None, processos=None, limitar_taxa=True):
+    flask_app.CONFIG["CAMINHO_MAPA_TICKER_CVM"] = diretorio / "mapeamento_tickers.csv"
+    flask_app.CONFIG["DIRETORIO_DADOS_CONSOLIDADOS"] = diretorio / "consolidated_data"
+    flask_app.CONFIG["DIRETORIO_SNAPSHOTS"] = diretorio / "consolidated_data" / "resultados"
+    flask_app.yf = stub
+    if processos is not None:
+        flask_app.CONFIG["HTTP_PROCESSOS"] = processos
+    if limitar_taxa:
+        flask_app.CLIENTE_HTTP = flask_app.criar_cliente_http(criar_sessao=lambda: stub)
+    else:
+        flask_app.CLIENTE_HTTP = ClienteHTTP(tentativas=1, criar_sessao=lambda: stub, metricas=flask_app.METRICAS)
+    if respostas_gravadas:
+        # Respostas gravadas nunca expiram durante o benchmark
+        for fonte in flask_app.CONFIG["TTL_CACHE_SEGUNDOS"]:
+            flask_app.CONFIG["TTL_CACHE_SEGUNDOS"][fonte] = float("inf")
+
+def reiniciar_cache_externo(diretorio, respostas_gravadas=None):
+    caminho = diretorio / "cache" / "dados_externos.sqlite3"
+    shutil.rmtree(caminho.parent, ignore_errors=True)
+    caminho.parent.mkdir(parents=True)
+    if respostas_gravadas:
+        shutil.copyfile(respostas_gravadas, caminho)
+    flask_app.CACHE_EXTERNO = CacheDisco(caminho, flask_app.CONFIG["CACHE_MAX_ENTRADAS"],
+                                         flask_app.CONFIG["CACHE_MAX_MB"] * 1024 * 1024)
+
+def medir_atualizador(diretorio, anos, repeticoes, workers, bytes_zips):
+    args = ["--manter-zips", "--workers", str(workers), "--historico-anos", str(len(anos) - 1)]
+    completo, incremental = [], []
+    for _ in range(repeticoes):
+        with contextlib.redirect_stdout(io.StringIO()):
+            sucesso, segundos = cronometrar(update_data.main, args + ["--completo"])
+            if not sucesso:
+                raise RuntimeError("update_data.main falhou durante o benchmark.")
+            completo.append(segundos)
+            incremental.append(cronometrar(update_data.main, args)[1])
+    manifesto = json.loads(update_data.CAMINHO_MANIFESTO.read_text(encoding="utf-8"))
+    linhas = sum(r["linhas"] for tipo in manifesto["particoes"].values() for r in tipo.values())
+    mediana = statistics.median(completo)
+    return {
+        "completo_segundos": resumir_tempos(completo),
+        "incremental_segundos": resumir_tempos(incremental),
+        "bytes_zips": bytes_zips, "linhas_gravadas": linhas,
+        "mb_por_segundo": round(bytes_zips / 1e6 / mediana, 3),
+        "linhas_por_segundo": round(linhas / mediana, 1),
+    }
+
+def medir_carregamento(repeticoes):
+    frio, quente = [], []
+    for _ in range(repeticoes):
+        flask_app.carregar_dados_preparados.cache_clear()
+        (_, erro), segundos = cronometrar(flask_app.carregar_dados_preparados)
+        if erro:
+            raise RuntimeError(f"carregar_dados_preparados falhou: {erro}")
+        frio.append(segundos)
+        quente.append(cronometrar(flask_app.carregar_dados_preparados)[1])
+    return {"frio_segundos": resumir_tempos(frio), "quente_segundos": resumir_tempos(quente)}
+
+def medir_valuation_por_ticker():
+    """Latência do caminho escalar por ticker e do caminho vetorizado, com o cache externo aquecido."""
+    flask_app.carregar_mapeamento_ticker_cvm.cache_clear()
+    demonstrativos, _ = flask_app.carregar_dados_preparados()
+    ticker_map, _ = flask_app.carregar_mapeamento_ticker_cvm()
+    market_data = flask_app.obter_dados_mercado()
+    empresas = [(f"{row.TICKER.upper()}.SA", row.CD_CVM)
+                for row in ticker_map.drop_duplicates(subset=["TICKER"]).itertuples(index=False)]
+    betas, segundos_betas = cronometrar(
+        flask_app.calcular_betas_em_lote, [ticker_sa for ticker_sa, _ in empresas], market_data["ibov_data"])
+
+    # Aquece as cotações antes de medir: a latência por ticker não inclui a espera pelo limite de taxa
+    for ticker_sa, _ in empresas:
+        flask_app.obter_dados_cotacao(ticker_sa)
+
+    latencias, validos = [], 0
+    for ticker_sa, codigo_cvm in empresas:
+        resultado, segundos = cronometrar(
+            flask_app.processar_valuation_empresa, ticker_sa, codigo_cvm, demonstrativos, market_data, betas)
+        latencias.append(segundos)
+        validos += resultado is not None
+
+    vetorizado = []
+    for _ in range(3):
+        inicio = time.perf_counter()
+        entradas = flask_app.montar_entradas_valuation(empresas, demonstrativos["fundamentos"], betas)
+        flask_app.calcular_valuation_vetorizado(entradas, market_data)
+        vetorizado.append(time.perf_counter() - inicio)
+    return {
+        "empresas": len(empresas), "resultados_validos": validos,
+        "betas_em_lote_segundos": round(segundos_betas, 6),
+        "escalar_por_ticker_segundos": resumir_tempos(latencias),
+        "vetorizado_total_segundos": resumir_tempos(vetorizado),
+        "vetorizado_por_ticker_segundos": round(statistics.median(vetorizado) / max(len(empresas), 1), 8),
+    }
+
+def medir_run_analysis(diretorio, repeticoes, respostas_gravadas, stub):
+    cliente = flask_app.app.test_client()
+    frio, quente, chamadas, resumo = [], [], [], None
+    for _ in range(repeticoes):
+        # A frio: sem snapshot, sem jobs e sem cache externo (o registro de jobs fica no
+        # diretório dos snapshots, então a instância em memória é descartada junto)
+        shutil.rmtree(flask_app.CONFIG["DIRETORIO_SNAPSHOTS"], ignore_errors=True)
+        flask_app._REGISTROS_JOBS.clear()
+        reiniciar_cache_externo(diretorio, respostas_gravadas)
+        flask_app.carregar_dados_preparados.cache_clear()
+        chamadas_antes = stub.chamadas
+        resposta, segundos = cronometrar(cliente.get, "/run_analysis")
+        if resposta.status_code != 200:
+            raise RuntimeError(f"/run_analysis respondeu {resposta.status_code}: {resposta.get_data(as_text=True)[:200]}")
+        frio.append(segundos)
+        chamadas.append(stub.chamadas - chamadas_antes)
+        resumo = flask_app.carregar_snapshot_valido().get("resumo_execucao")
+        quente.append(cronometrar(cliente.get, "/run_analysis")[1])
+    return {
+        "frio_segundos": resumir_tempos(frio), "quente_segundos": resumir_tempos(quente),
+        "chamadas_stub_por_execucao": chamadas, "empresas_no_resultado": len(resposta.get_json()),
+        "resumo_execucao": resumo,
+    }
+
+def versao_codigo():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=BASE_DIR,
+                              capture_output=True, text=True, timeout=10).stdout.strip() or None
+    except Exception:
+        return None
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark offline do atualizador e da análise de valuation.")
+    parser.add_argument("--empresas", type=int, default=400, help="Empresas no mapeamento de tickers.")
+    parser.add_argument("--empresas-extras", type=int, default=400,
+                        help="Empresas nos ZIPs que não estão no mapeamento (descartadas na leitura).")
+    parser.add_argument("--anos", type=int, default=3, help="Anos de ZIPs DFP a gerar (terminando no ano atual).")
+    parser.add_argument("--repeticoes", type=int, default=3, help="Repetições de cada medição.")
+    parser.add_argument("--workers", type=int, default=1, help="Processos do update_data.py.")
+    parser.add_argument("--latencia-ms", type=float, default=0.0, help="Latência simulada por chamada ao stub.")
+    parser.add_argument("--processos", type=int,
+                        help="Workers entre os quais o limite por host é dividido (padrão: HTTP_PROCESSOS do CONFIG).")
+    parser.add_argument("--sem-limite-taxa", action="store_true",
+                        help="Não aplica os limites por host do CONFIG às chamadas ao stub.")
+    parser.add_argument("--respostas-gravadas", type=Path,
+                        help="Cache SQLite (dados_externos.sqlite3) com respostas reais gravadas.")
+    parser.add_argument("--saida", type=Path, default=BASE_DIR / "benchmark_resultados.json",
+                        help="Arquivo JSON de saída.")
+    args = parser.parse_args(argv)
+
+    logging.getLogger().setLevel(logging.ERROR)
+    ano_atual = datetime.today().year
+    anos = list(range(ano_atual - args.anos + 1, ano_atual + 1))
+    codigos = list(range(1000, 1000 + args.empresas))
+    stub = StubMercado(latencia=args.latencia_ms / 1000)
+
+    with tempfile.TemporaryDirectory(prefix="benchmark_valuation_") as temporario:
+        diretorio = Path(temporario)
+        (diretorio / "CVM_DATA").mkdir()
+        gerar_mapeamento(diretorio / "mapeamento_tickers.csv", codigos)
+        bytes_zips = gerar_zips_dfp(diretorio / "CVM_DATA", anos, codigos, args.empresas_extras)
+        configurar_atualizador(diretorio)
+        configurar_aplicacao(diretorio, stub, args.respostas_gravadas, args.processos, not args.sem_limite_taxa)
+        reiniciar_cache_externo(diretorio, args.respostas_gravadas)
+
+        print(f"Benchmark: {args.empresas} empresas (+{args.empresas_extras} fora do mapa), anos {anos[0]}-{anos[-1]}, "
+              f"{bytes_zips / 1e6:.1f} MB de ZIPs.")
+        resultados = {"atualizador": medir_atualizador(diretorio, anos, args.repeticoes, args.workers, bytes_zips)}
+        print(f"  atualizador: {resultados['atualizador']['completo_segundos']['mediana']:.3f}s")
+        resultados["carregar_dados_preparados"] = medir_carregamento(args.repeticoes)
+        print(f"  carregar_dados_preparados (frio): {resultados['carregar_dados_preparados']['frio_segundos']['mediana']:.3f}s")
+        resultados["valuation"] = medir_valuation_por_ticker()
+        print(f"  valuation escalar p50/ticker: {resultados['valuation']['escalar_por_ticker_segundos']['mediana'] * 1000:.2f}ms")
+        resultados["run_analysis"] = medir_run_analysis(diretorio, args.repeticoes, args.respostas_gravadas, stub)
+        print(f"  /run_analysis frio/quente: {resultados['run_analysis']['frio_segundos']['mediana']:.3f}s / "
+              f"{resultados['run_analysis']['quente_segundos']['mediana'] * 1000:.1f}ms")
+
+    saida = {
+        "versao_codigo": versao_codigo(), "executado_em": datetime.now().isoformat(timespec="seconds"),
+        "ambiente": {"python": platform.python_version(), "pandas": pd.__version__,
+                     "numpy": np.__version__, "plataforma": platform.platform()},
+        "parametros": {k: (str(v) if isinstance(v, Path) else v) for k, v in vars(args).items()},
+        "limites_http_por_processo": flask_app.CLIENTE_HTTP.limites_por_host,
+        "resultados": resultados,
+    }
+    args.saida.write_text(json.dumps(saida, indent=2, ensure_ascii=False), encoding="utf-8")
+    print(f"✓ Resultados gravados em {args.saida}")
+    return True
+
+if __name__ == "__main__":
+    sys.exit(0 if main() else 1)
@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+"""
+Cache persistente (SQLite) para as chamadas a fontes externas (yfinance e BCB).
+
+Cada entrada guarda o valor serializado com pickle e o instante em que foi obtida.
+Leituras dentro do TTL são servidas direto do disco; entre o TTL e TTL + janela_stale o
+valor antigo é devolvido imediatamente e uma thread em segundo plano o atualiza
+(stale-while-revalidate). O arquivo é compartilhado entre processos (workers do gunicorn)
+e sobrevive a reinícios. O tamanho é limitado por número de entradas e por bytes,
+descartando primeiro as entradas acessadas há mais tempo. Os instantes de acesso são
+acumulados em memória e gravados em lote, para que as leituras não abram uma transação de
+escrita (que serializaria os workers) a cada acerto.
+"""
+import logging
+import pickle
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+# Intervalo mínimo (segundos) entre as gravações em lote dos instantes de acesso
+INTERVALO_REGISTRO_ACESSOS = 30
+
+
+class CacheDisco:
+    def __init__(self, caminho, max_entradas=5000, max_bytes=256 * 1024 * 1024):
+        self.caminho = Path(caminho)
+        self.max_entradas = max_entradas
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._atualizando = set()
+        self._inicializado = False
+        self._acessos_pendentes = {}
+        self._ultimo_registro_acessos = time.monotonic()
+
+    @contextmanager
+    def _conectar(self):
+        if not self._inicializado:
+            self.caminho.parent.mkdir(parents=True, exist_ok=True)
+        conexao = sqlite3.connect(self.caminho, timeout=30)
+        if not self._inicializado:
+            conexao.execute("PRAGMA journal_mode=WAL")
+            conexao.execute(
+                "CREATE TABLE IF NOT EXISTS cache ("
+                " chave TEXT PRIMARY KEY, valor BLOB NOT NULL, tamanho INTEGER NOT NULL,"
+                " criado_em REAL NOT NULL, acessado_em REAL NOT NULL)"
+            )
+            conexao.execute("CREATE INDEX IF NOT EXISTS idx_cache_acesso ON cache (acessado_em)")
+            self._inicializado = True
+        try:
+            with conexao:
+                yield conexao
+        finally:
+            conexao.close()
+
+    def _retirar_acessos_pendentes(self, forcar=False):
+        """Devolve (e esvazia) os acessos acumulados quando é hora de gravá-los."""
+        with self._lock:
+            if not self._acessos_pendentes:
+                return {}
+            if not forcar and time.monotonic() - self._ultimo_registro_acessos < INTERVALO_REGISTRO_ACESSOS:
+                return {}
+            pendentes, self._acessos_pendentes = self._acessos_pendentes, {}
+            self._ultimo_registro_acessos = time.monotonic()
+        return pendentes
+
+    @staticmethod
+    def _gravar_acessos(conexao, pendentes):
+        conexao.executemany("UPDATE cache SET acessado_em = ? WHERE chave = ?",
+                            [(instante, chave) for chave, instante in pendentes.items()])
+
+    def ler(self, chave):
+        """Retorna (valor, idade_em_segundos) ou (None, None) se a chave não existir."""
+        try:
+            with self._conectar() as conexao:
+                linha = conexao.execute("SELECT valor, criado_em FROM cache WHERE chave = ?", (chave,)).fetchone()
+            if linha is None:
+                return None, None
+            agora = time.time()
+            with self._lock:
+                self._acessos_pendentes[chave] = agora
+            pendentes = self._retirar_acessos_pendentes()
+            if pendentes:
+                with self._conectar() as conexao:
+                    self._gravar_acessos(conexao, pendentes)
+            return pickle.loads(linha[0]), agora - linha[1]
+        except Exception as e:
+            logging.warning(f"Falha ao ler o cache para '{chave}': {e}")
+            return None, None
+
+    def gravar(self, chave, valor):
+        try:
+            dados = pickle.dumps(valor, protocol=pickle.HIGHEST_PROTOCOL)
+            agora = time.time()
+            with self._conectar() as conexao:
+                conexao.execute(
+                    "INSERT OR REPLACE INTO cache (chave, valor, tamanho, criado_em, acessado_em) VALUES (?, ?, ?, ?, ?)",
+                    (chave, dados, len(dados), agora, agora),
+                )
+                # Os descartes por LRU precisam dos instantes de acesso atualizados
+                self._gravar_acessos(conexao, self._retirar_acessos_pendentes(forcar=True))
+                self._aplicar_limites(conexao)
+        except Exception as e:
+            logging.warning(f"Falha ao gravar o cache para '{chave}': {e}")
+
+    def _aplicar_limites(self, conexao):
+        total_entradas, total_bytes = conexao.execute("SELECT COUNT(*), COALESCE(SUM(tamanho), 0) FROM cache").fetchone()
+        if total_entradas <= self.max_entradas and total_bytes <= self.max_bytes:
+            return
+        excedentes = []
+        for chave, tamanho in conexao.execute("SELECT chave, tamanho FROM cache ORDER BY acessado_em"):
+            if total_entradas <= self.max_entradas and total_bytes <= self.max_bytes:
+                break
+            excedentes.append((chave,))
+            total_entradas -= 1
+            total_bytes -= tamanho
+        conexao.executemany("DELETE FROM cache WHERE chave = ?", excedentes)
+
+    def obter(self, chave, ttl, carregar, janela_stale=0, pode_gravar=None, com_idade=False):
+        """
+        Retorna o valor da chave, chamando `carregar()` quando necessário.
+
+        - idade <= ttl: valor do cache.
+        - ttl < idade <= ttl + janela_stale: valor do cache, com atualização em segundo plano.
+        - caso contrário: `carregar()` síncrono; se falhar e houver valor antigo, ele é usado.
+        Exceções de `carregar()` só são propagadas quando não há nenhum valor em cache.
+        Se `pode_gravar(valor)` for falso, o valor carregado é devolvido mas não é gravado.
+        Com `com_idade=True` devolve (valor, idade_em_segundos do valor devolvido).
+        """
+        valor, idade = self.ler(chave)
+        if idade is not None and idade <= ttl:
+            return (valor, idade) if com_idade else valor
+        if idade is not None and idade <= ttl + janela_stale:
+            self._atualizar_em_segundo_plano(chave, carregar, pode_gravar)
+            return (valor, idade) if com_idade else valor
+        try:
+            novo_valor = carregar()
+        except Exception as e:
+            if idade is None:
+                raise
+            logging.warning(f"Falha ao atualizar '{chave}'; usando valor em cache de {idade:.0f}s atrás. Erro: {e}")
+            return (valor, idade) if com_idade else valor
+        if pode_gravar is None or pode_gravar(novo_valor):
+            self.gravar(chave, novo_valor)
+        return (novo_valor, 0.0) if com_idade else novo_valor
+
+    def _atualizar_em_segundo_plano(self, chave, carregar, pode_gravar=None):
+        with self._lock:
+            if chave in self._atualizando:
+                return
+            self._atualizando.add(chave)
+
+        def tarefa():
+            try:
+                novo_valor = carregar()
+                if pode_gravar is None or pode_gravar(novo_valor):
+                    self.gravar(chave, novo_valor)
+            except Exception as e:
+                logging.warning(f"Falha na atualização em segundo plano de '{chave}': {e}")
+            finally:
+                with self._lock:
+                    self._atualizando.discard(chave)
+
+        threading.Thread(target=tarefa, name=f"cache-{chave}", daemon=True).start()
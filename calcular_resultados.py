@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+"""
+Geração Offline do Snapshot de Resultados do Valuation
+
+Roda a análise completa (a mesma de /run_analysis) e publica o snapshot versionado em
+consolidated_data/resultados/snapshot_atual.json, identificado pelos hashes das entradas
+(demonstrativos consolidados e mapa de tickers) e pelo instante dos dados de mercado.
+A aplicação web serve esse arquivo diretamente enquanto ele for válido, e todos os
+workers compartilham a mesma cópia em disco.
+
+Uso típico, logo após o update_data.py:
+    python calcular_resultados.py [--forcar]
+"""
+import argparse
+import logging
+import sys
+import time
+
+from flask_app import carregar_snapshot_valido, gerar_snapshot_resultados
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Gera o snapshot materializado dos resultados do valuation.")
+    parser.add_argument("--forcar", action="store_true",
+                        help="Recalcula mesmo que o snapshot atual ainda seja válido.")
+    args = parser.parse_args(argv)
+
+    if not args.forcar:
+        snapshot = carregar_snapshot_valido()
+        if snapshot is not None:
+            print(f"✓ Snapshot {snapshot['chave']} ainda é válido ({len(snapshot['resultados'])} empresas). Nada a fazer.")
+            return True
+
+    snapshot, erro = gerar_snapshot_resultados()
+    if erro:
+        logging.error(f"✗ Falha ao gerar o snapshot de resultados: {erro}")
+        return False
+    print(f"✓ Snapshot {snapshot.get('chave', '(não gravado)')} gerado com {len(snapshot['resultados'])} empresas.")
+    return True
+
+if __name__ == "__main__":
+    inicio = time.time()
+    sucesso = main()
+    print(f"\nTempo total de execução: {time.time() - inicio:.2f} segundos.")
+    sys.exit(0 if sucesso else 1)
@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+"""
+Cliente compartilhado para as fontes externas (API SGS do BCB e Yahoo Finance).
+
+Reúne o que cada chamada fazia por conta própria:
+- uma única requests.Session com pool de conexões keep-alive (sem novo handshake TLS por série);
+- limite de taxa por host (token bucket), para não disparar o throttling dos provedores
+  quando a análise roda com vários workers;
+- novas tentativas com backoff exponencial e jitter para erros transitórios
+  (timeout, conexão, HTTP 429/5xx), respeitando o cabeçalho Retry-After;
+- coalescência: requisições idênticas em andamento ao mesmo tempo viram uma só chamada.
+
+Os limitadores vivem em cada processo (cada worker do gunicorn tem o seu cliente). Para que
+N workers juntos respeitem o orçamento de um host, cada um recebe a sua parcela dos limites
+(ver dividir_limites). Depois de um fork a sessão e os limitadores são recriados, para que os
+workers não compartilhem sockets.
+"""
+import logging
+import os
+import random
+import threading
+import time
+from concurrent.futures import Future
+from urllib.parse import urlsplit
+
+STATUS_TRANSITORIOS = {429, 500, 502, 503, 504}
+# Trechos do nome das exceções tratadas como transitórias (requests, curl_cffi e yfinance)
+NOMES_ERROS_TRANSITORIOS = ("Timeout", "ConnectionError", "RateLimit")
+
+
+class ErroTransitorio(Exception):
+    """Falha que deve passar pela política de novas tentativas (ex.: tickers sem preços no download)."""
+
+
+def criar_sessao_requests(tamanho_pool=16):
+    """requests.Session com um pool de até `tamanho_pool` conexões keep-alive por host."""
+    import requests
+    from requests.adapters import HTTPAdapter
+
+    sessao = requests.Session()
+    adaptador = HTTPAdapter(pool_connections=tamanho_pool, pool_maxsize=tamanho_pool)
+    sessao.mount("https://", adaptador)
+    sessao.mount("http://", adaptador)
+    return sessao
+
+
+def dividir_limites(limites_por_host, processos):
+    """
+    Parcela de um processo nos limites {host: (requisições por segundo, rajada)} divididos entre
+    `processos` workers: a taxa é dividida igualmente e a rajada também, com no mínimo uma ficha.
+    """
+    processos = max(1, int(processos))
+    return {host: (taxa / processos, max(1.0, rajada / processos))
+            for host, (taxa, rajada) in limites_por_host.items()}
+
+
+def erro_transitorio(erro):
+    """Indica se vale a pena repetir a chamada que gerou `erro`."""
+    if isinstance(erro, ErroTransitorio):
+        return True
+    resposta = getattr(erro, "response", None)
+    status = getattr(resposta, "status_code", None)
+    if status is not None:
+        return status in STATUS_TRANSITORIOS
+    return any(trecho in classe.__name__ for classe in type(erro).__mro__ for trecho in NOMES_ERROS_TRANSITORIOS)
+
+
+def _espera_retry_after(erro):
+    """Segundos pedidos pelo cabeçalho Retry-After da resposta de erro, se houver."""
+    resposta = getattr(erro, "response", None)
+    try:
+        return float(resposta.headers.get("Retry-After"))
+    except (AttributeError, TypeError, ValueError):
+        return None
+
+
+class LimitadorTaxa:
+    """Token bucket: até `capacidade` chamadas de uma vez, reabastecido a `taxa` fichas por segundo."""
+
+    def __init__(self, taxa, capacidade=None):
+        self.taxa = float(taxa)
+        self.capacidade = float(capacidade or max(1.0, self.taxa))
+        self._fichas = self.capacidade
+        self._ultimo = time.monotonic()
+        self._lock = threading.Lock()
+
+    def adquirir(self):
+        """Bloqueia até haver uma ficha disponível e devolve quanto tempo esperou."""
+        esperado = 0.0
+        while True:
+            with self._lock:
+                agora = time.monotonic()
+                self._fichas = min(self.capacidade, self._fichas + (agora - self._ultimo) * self.taxa)
+                self._ultimo = agora
+                if self._fichas >= 1:
+                    self._fichas -= 1
+                    return esperado
+                espera = (1 - self._fichas) / self.taxa
+            time.sleep(espera)
+            esperado += espera
+
+
+class ClienteHTTP:
+    def __init__(self, limites_por_host=None, tentativas=3, espera_base=0.5, espera_maxima=8.0,
+                 timeout=10, criar_sessao=criar_sessao_requests, metricas=None):
+        """
+        limites_por_host: {host: (requisições por segundo, rajada)}; hosts ausentes não são limitados.
+        criar_sessao: fábrica (sem argumentos) da sessão usada por obter_json.
+        metricas: RegistroMetricas opcional para contar requisições, novas tentativas e esperas.
+        """
+        self.limites_por_host = dict(limites_por_host or {})
+        self.tentativas = max(1, int(tentativas))
+        self.espera_base = espera_base
+        self.espera_maxima = espera_maxima
+        self.timeout = timeout
+        self.metricas = metricas
+        self._criar_sessao = criar_sessao
+        self._lock = threading.Lock()
+        self._reiniciar_estado()
+
+    def _reiniciar_estado(self):
+        self._pid = os.getpid()
+        self._sessao = None
+        self._limitadores = {}
+        self._em_andamento = {}
+
+    def _verificar_fork(self):
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._reiniciar_estado()
+
+    @property
+    def sessao(self):
+        self._verificar_fork()
+        if self._sessao is None:
+            with self._lock:
+                if self._sessao is None:
+                    self._sessao = self._criar_sessao()
+        return self._sessao
+
+    def _contar(self, nome, host, valor=1):
+        if self.metricas is not None:
+            self.metricas.incrementar(nome, valor, host=host)
+
+    def _aguardar_limite(self, host, fichas=1):
+        limite = self.limites_por_host.get(host)
+        if limite is None:
+            return
+        with self._lock:
+            limitador = self._limitadores.get(host)
+            if limitador is None:
+                limitador = self._limitadores[host] = LimitadorTaxa(*limite)
+        # Uma ficha de cada vez: pedidos maiores que a rajada são espaçados pela taxa do host
+        esperado = sum(limitador.adquirir() for _ in range(fichas))
+        if esperado and self.metricas is not None:
+            self.metricas.registrar_duracao("http_espera_limite_segundos", esperado, host=host)
+
+    def _espera_backoff(self, tentativa, erro):
+        """Backoff exponencial com jitter completo; nunca menos que o Retry-After do servidor."""
+        espera = random.uniform(0, min(self.espera_maxima, self.espera_base * 2 ** tentativa))
+        pedido = _espera_retry_after(erro)
+        if pedido is not None:
+            espera = max(espera, min(pedido, self.espera_maxima))
+        return espera
+
+    def _com_tentativas(self, host, funcao, fichas):
+        for tentativa in range(self.tentativas):
+            quantidade = fichas() if callable(fichas) else fichas
+            self._aguardar_limite(host, quantidade)
+            self._contar("http_requisicoes_total", host, quantidade)
+            try:
+                return funcao()
+            except Exception as e:
+                if tentativa + 1 >= self.tentativas or not erro_transitorio(e):
+                    raise
+                espera = self._espera_backoff(tentativa, e)
+                self._contar("http_retentativas_total", host)
+                logging.info(f"Erro transitório em {host} (tentativa {tentativa + 1}/{self.tentativas}); "
+                             f"nova tentativa em {espera:.2f}s. Erro: {e}")
+                time.sleep(espera)
+
+    def executar(self, host, funcao, chave=None, fichas=1):
+        """
+        Executa `funcao()` sob o limite de taxa e a política de novas tentativas de `host`.
+        `fichas` é o número de requisições que cada tentativa faz ao host (ou uma função que o
+        devolve, consultada a cada tentativa). Chamadas simultâneas com a mesma `chave` (quando
+        informada) compartilham uma única execução e recebem o mesmo objeto de resultado, que não
+        deve ser modificado.
+        """
+        self._verificar_fork()
+        if chave is None:
+            return self._com_tentativas(host, funcao, fichas)
+        with self._lock:
+            futuro = self._em_andamento.get(chave)
+            lider = futuro is None
+            if lider:
+                futuro = self._em_andamento[chave] = Future()
+        if not lider:
+            self._contar("http_coalescidas_total", host)
+            return futuro.result()
+        try:
+            resultado = self._com_tentativas(host, funcao, fichas)
+            futuro.set_result(resultado)
+            return resultado
+        except BaseException as e:
+            futuro.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._em_andamento.pop(chave, None)
+
+    def obter_json(self, url, params=None):
+        """GET de `url` devolvendo o JSON decodificado; erros HTTP viram exceções."""
+        def requisitar():
+            resposta = self.sessao.get(url, params=params, timeout=self.timeout)
+            resposta.raise_for_status()
+            return resposta.json()
+        chave = ("GET", url, tuple(sorted((params or {}).items())))
+        return self.executar(urlsplit(url).hostname, requisitar, chave=chave)
@@ -1,15 +1,28 @@
 #!/usr/bin/env python3
 import pandas as pd
-import yfinance as yf
-import requests
 from pathlib import Path
 import warnings
 import numpy as np
-from flask import Flask, render_template, jsonify
+from flask import Flask, render_template, jsonify, url_for, request
 import logging
-from scipy import stats
 from functools import lru_cache
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import threading
+import hashlib
+import time
+import uuid
+import json
+import os
+import gzip
+import math
+import importlib
+import importlib.util
+from contextlib import contextmanager
+from cache_dados import CacheDisco
+from metricas import RegistroMetricas
+from cliente_http import ClienteHTTP, ErroTransitorio, criar_sessao_requests, dividir_limites
+from registro_jobs import RegistroJobs
 
 # --- Configuração Básica ---
 warnings.filterwarnings("ignore")
@@ -18,6 +31,23 @@ logging.basicConfig(
     format="%(asctime)s - %(levelname)s - [%(filename)s:%(lineno)d] - %(message)s"
 )
 
+class _ModuloSobDemanda:
+    """Importa o módulo no primeiro acesso a um atributo (yfinance e scipy são lentos de importar)."""
+    def __init__(self, nome):
+        self._nome = nome
+        self._modulo = None
+
+    def carregar(self):
+        if self._modulo is None:
+            self._modulo = importlib.import_module(self._nome)
+        return self._modulo
+
+    def __getattr__(self, atributo):
+        return getattr(self.carregar(), atributo)
+
+yf = _ModuloSobDemanda("yfinance")
+stats = _ModuloSobDemanda("scipy.stats")
+
 app = Flask(__name__)
 BASE_DIR = Path(__file__).resolve().parent
 
@@ -26,6 +56,11 @@ CONFIG = {
     "DIRETORIO_DADOS_CONSOLIDADOS": BASE_DIR / "consolidated_data",
     "CAMINHO_MAPA_TICKER_CVM": BASE_DIR / "mapeamento_tickers.csv",
     "PERIODO_BETA_IBOV": "5y",
+    "TAMANHO_LOTE_BETA": 100,
+    # Execução concorrente da análise (1 = sequencial)
+    "MAX_WORKERS_ANALISE": 8,
+    "LIMITE_GLOBAL_CONCORRENCIA": 16,
+    "TIMEOUT_TICKER_SEGUNDOS": 60,
     "CONTAS_CVM": {
         "EBIT": "3.05", "IMPOSTO_DE_RENDA_CSLL": "3.10", "LUCRO_ANTES_IMPOSTOS": "3.09",
         "ATIVO_NAO_CIRCULANTE": "1.02", "CAIXA_EQUIVALENTES": "1.01.01",
@@ -33,23 +68,242 @@ CONFIG = {
         "CONTAS_A_RECEBER": "1.01.03", "ESTOQUES": "1.01.04", "FORNECEDORES": "2.01.02",
         "DESPESAS_FINANCEIRAS": "3.07" 
     },
+    # Demonstrativo de origem de cada conta de CONTAS_CVM
+    "ORIGEM_CONTAS_CVM": {
+        "EBIT": "dre", "IMPOSTO_DE_RENDA_CSLL": "dre", "LUCRO_ANTES_IMPOSTOS": "dre",
+        "DESPESAS_FINANCEIRAS": "dre", "ATIVO_NAO_CIRCULANTE": "bpa", "CAIXA_EQUIVALENTES": "bpa",
+        "CONTAS_A_RECEBER": "bpa", "ESTOQUES": "bpa", "DIVIDA_CURTO_PRAZO": "bpp",
+        "DIVIDA_LONGO_PRAZO": "bpp", "FORNECEDORES": "bpp",
+    },
+    # Cache persistente das fontes externas (TTL e janela stale-while-revalidate em segundos)
+    "CAMINHO_CACHE_EXTERNO": BASE_DIR / "cache" / "dados_externos.sqlite3",
+    "TTL_CACHE_SEGUNDOS": {"cotacao": 15 * 60, "precos": 4 * 3600, "bcb": 24 * 3600},
+    "JANELA_STALE_SEGUNDOS": {"cotacao": 6 * 3600, "precos": 24 * 3600, "bcb": 3 * 24 * 3600},
+    "CACHE_MAX_ENTRADAS": 5000,
+    "CACHE_MAX_MB": 256,
+    # Snapshot materializado dos resultados (gerado por calcular_resultados.py ou pelos jobs)
+    "DIRETORIO_SNAPSHOTS": BASE_DIR / "consolidated_data" / "resultados",
+    "VALIDADE_SNAPSHOT_SEGUNDOS": 6 * 3600,
+    "MAX_SNAPSHOTS_ARMAZENADOS": 5,
+    # Consulta paginada de resultados (/resultados)
+    "TAMANHO_PAGINA_PADRAO": 50,
+    "TAMANHO_PAGINA_MAXIMO": 500,
+    # Jobs de análise em segundo plano
+    "VALIDADE_JOB_SEGUNDOS": 15 * 60,
+    "MAX_JOBS_ARMAZENADOS": 20,
+    # Frequência de gravação do progresso e prazo sem atualização para um job ser dado como abandonado
+    "INTERVALO_PROGRESSO_JOB_SEGUNDOS": 2,
+    "PRAZO_ABANDONO_JOB_SEGUNDOS": 60,
+    # Validade do valuation histórico calculado (o job também é refeito quando as entradas mudam)
+    "VALIDADE_HISTORICO_SEGUNDOS": 6 * 3600,
+    # "vetorizado" calcula todas as empresas de uma vez; "escalar" usa processar_valuation_empresa
+    "MODO_VALUATION": "vetorizado",
+    # Máximo de pontos (combinações de premissas) por consulta de /sensibilidade
+    "MAX_PONTOS_SENSIBILIDADE": 2500,
+    # Aquecimento na inicialização: "" (desligado), "sincrono" (na importação; com o
+    # `gunicorn --preload`, os workers herdam os dados já carregados) ou "segundo_plano"
+    "AQUECIMENTO_INICIAL": os.environ.get("VALUATION_AQUECIMENTO", "").strip().lower(),
+    # Cliente HTTP das fontes externas: limite por host (requisições/s, rajada), novas tentativas
+    # com backoff exponencial + jitter e tamanho do pool de conexões keep-alive.
+    # Os limites são o orçamento total do host, somando todos os workers: cada processo fica com
+    # a fração 1/HTTP_PROCESSOS (WEB_CONCURRENCY, a mesma variável que o gunicorn usa para o
+    # número de workers). O Yahoo recebe uma requisição de cotação e uma de preços por ticker,
+    # então uma análise a frio do mapa completo (~670 tickers) passa cerca de 2 × 670 / 5 ≈ 270 s
+    # esperando o limite, ou HTTP_PROCESSOS vezes isso no worker que executa o job.
+    "HTTP_LIMITES_POR_HOST": {"api.bcb.gov.br": (5, 5), "finance.yahoo.com": (5, 10)},
+    "HTTP_PROCESSOS": int(os.environ.get("WEB_CONCURRENCY") or 1),
+    "HTTP_TENTATIVAS": 3,
+    "HTTP_ESPERA_BASE_SEGUNDOS": 0.5,
+    "HTTP_ESPERA_MAXIMA_SEGUNDOS": 8,
+    "HTTP_TIMEOUT_SEGUNDOS": 10,
+    "HTTP_TAMANHO_POOL": 16,
+    # Threads internas do yf.download (uma requisição por ticker)
+    "YAHOO_THREADS_DOWNLOAD": 4,
 }
 
+# Limite global de tarefas simultâneas, compartilhado entre requisições concorrentes
+_SEMAFORO_TAREFAS = threading.BoundedSemaphore(CONFIG["LIMITE_GLOBAL_CONCORRENCIA"])
+
+METRICAS = RegistroMetricas()
+
+CACHE_EXTERNO = CacheDisco(
+    CONFIG["CAMINHO_CACHE_EXTERNO"],
+    max_entradas=CONFIG["CACHE_MAX_ENTRADAS"],
+    max_bytes=CONFIG["CACHE_MAX_MB"] * 1024 * 1024,
+)
+
+# Host usado como chave do limite de taxa das chamadas ao yfinance
+HOST_YAHOO = "finance.yahoo.com"
+
+def criar_cliente_http(criar_sessao=None):
+    """ClienteHTTP configurado pelo CONFIG, com a parcela deste processo nos limites por host."""
+    return ClienteHTTP(
+        dividir_limites(CONFIG["HTTP_LIMITES_POR_HOST"], CONFIG["HTTP_PROCESSOS"]), tentativas=CONFIG["HTTP_TENTATIVAS"],
+        espera_base=CONFIG["HTTP_ESPERA_BASE_SEGUNDOS"], espera_maxima=CONFIG["HTTP_ESPERA_MAXIMA_SEGUNDOS"],
+        timeout=CONFIG["HTTP_TIMEOUT_SEGUNDOS"],
+        criar_sessao=criar_sessao or (lambda: criar_sessao_requests(CONFIG["HTTP_TAMANHO_POOL"])),
+        metricas=METRICAS,
+    )
+
+CLIENTE_HTTP = criar_cliente_http()
+
+# Coletas ativas do instante dos dados externos usados (ver coletar_instante_dados_mercado)
+_COLETAS_INSTANTE_MERCADO = []
+_LOCK_COLETAS_MERCADO = threading.Lock()
+
+@contextmanager
+def coletar_instante_dados_mercado():
+    """
+    Registra em coleta["instante"] o instante em que foi obtido o dado externo mais antigo
+    (cotação, preços ou série do BCB, inclusive os servidos do cache) usado durante o bloco.
+    Com execuções simultâneas as coletas se sobrepõem, o que só torna o instante mais antigo.
+    """
+    coleta = {"instante": None}
+    with _LOCK_COLETAS_MERCADO:
+        _COLETAS_INSTANTE_MERCADO.append(coleta)
+    try:
+        yield coleta
+    finally:
+        with _LOCK_COLETAS_MERCADO:
+            _COLETAS_INSTANTE_MERCADO.remove(coleta)
+
+def obter_com_cache(fonte, chave, carregar, pode_gravar=None):
+    """
+    Consulta o cache persistente usando o TTL e a janela stale configurados para a fonte.
+    Registra acertos/faltas do cache e a quantidade, duração e falhas das chamadas de rede.
+    Valores para os quais `pode_gravar(valor)` é falso são devolvidos sem ir para o cache.
+    """
+    buscou_na_rede = []
+
+    def carregar_medido():
+        buscou_na_rede.append(True)
+        METRICAS.incrementar("chamadas_rede_total", fonte=fonte)
+        try:
+            with METRICAS.cronometrar("chamada_rede_segundos", fonte=fonte):
+                return carregar()
+        except Exception:
+            METRICAS.incrementar("chamadas_rede_falhas_total", fonte=fonte)
+            raise
+
+    valor, idade = CACHE_EXTERNO.obter(
+        f"{fonte}:{chave}", CONFIG["TTL_CACHE_SEGUNDOS"][fonte], carregar_medido,
+        janela_stale=CONFIG["JANELA_STALE_SEGUNDOS"][fonte], pode_gravar=pode_gravar, com_idade=True,
+    )
+    obtido_em = time.time() - idade
+    with _LOCK_COLETAS_MERCADO:
+        for coleta in _COLETAS_INSTANTE_MERCADO:
+            if coleta["instante"] is None or obtido_em < coleta["instante"]:
+                coleta["instante"] = obtido_em
+    METRICAS.incrementar("cache_consultas_total", fonte=fonte, resultado="falta" if buscou_na_rede else "acerto")
+    return valor
+
 # --- Funções Utilitárias de Carregamento de Dados ---
 
-def carregar_csv_robusto(caminho_arquivo, **kwargs):
-    separators = [",", ";"]
-    encodings = ["utf-8", "latin-1", "cp1252"]
-    kwargs.pop("low_memory", None)
-    for sep in separators:
-        for encoding in encodings:
-            try:
-                df = pd.read_csv(caminho_arquivo, sep=sep, encoding=encoding, engine='python', **kwargs)
-                if len(df.columns) > 1:
-                    return df
-            except Exception:
-                continue
-    raise Exception(f"Não foi possível carregar o arquivo '{caminho_arquivo.name}' corretamente.")
+# Leitor de CSV: pyarrow (multithread) quando instalado, senão o parser em C do pandas
+MOTOR_CSV = "pyarrow" if importlib.util.find_spec("pyarrow") else "c"
+TAMANHO_AMOSTRA_CSV = 64 * 1024
+
+def _ler_metadados_csv(caminho_arquivo):
+    """Lê o arquivo de metadados gravado pelo update_data.py, se ele corresponder ao CSV atual."""
+    caminho_metadados = caminho_arquivo.with_suffix(".meta.json")
+    if not caminho_metadados.exists():
+        return None
+    try:
+        metadados = json.loads(caminho_metadados.read_text(encoding="utf-8"))
+        if metadados.get("tamanho_bytes") != caminho_arquivo.stat().st_size:
+            return None
+        return {"sep": metadados["sep"], "encoding": metadados["encoding"], "colunas": metadados["colunas"]}
+    except (OSError, ValueError, KeyError) as e:
+        logging.warning(f"Metadados de '{caminho_arquivo.name}' ilegíveis; detectando o formato pela amostra. Erro: {e}")
+        return None
+
+def detectar_formato_csv(caminho_arquivo):
+    """
+    Retorna {"sep", "encoding", "colunas"} do CSV, a partir dos metadados do update_data.py ou,
+    na falta deles, de uma amostra dos primeiros bytes do arquivo.
+    """
+    metadados = _ler_metadados_csv(caminho_arquivo)
+    if metadados is not None:
+        return metadados
+    with open(caminho_arquivo, "rb") as arquivo:
+        amostra = arquivo.read(TAMANHO_AMOSTRA_CSV)
+    if len(amostra) == TAMANHO_AMOSTRA_CSV and b"\n" in amostra:
+        # Descarta a última linha, possivelmente cortada no meio de um caractere multibyte
+        amostra = amostra[:amostra.rindex(b"\n")]
+    encoding = "utf-8-sig" if amostra.startswith(b"\xef\xbb\xbf") else "utf-8"
+    try:
+        texto = amostra.decode(encoding)
+    except UnicodeDecodeError:
+        encoding = "latin-1"
+        texto = amostra.decode(encoding)
+    cabecalho = texto.splitlines()[0] if texto else ""
+    sep = max([",", ";"], key=cabecalho.count)
+    colunas = [coluna.strip().strip('"') for coluna in cabecalho.split(sep)]
+    if len(colunas) <= 1:
+        raise ValueError(f"Não foi possível detectar o separador de '{caminho_arquivo.name}'.")
+    return {"sep": sep, "encoding": encoding, "colunas": colunas}
+
+def carregar_csv_rapido(caminho_arquivo, colunas=None, dtype=None):
+    """
+    Lê o CSV numa única passada com o motor em C/pyarrow.
+
+    `colunas` restringe a leitura às colunas cujos nomes (sem espaços, em maiúsculas) estão no
+    conjunto; `dtype` usa esses mesmos nomes normalizados. As colunas do DataFrame devolvido
+    também vêm normalizadas.
+    """
+    formato = detectar_formato_csv(caminho_arquivo)
+    nomes = {coluna: coluna.strip().upper() for coluna in formato["colunas"]}
+    usecols = [coluna for coluna, nome in nomes.items() if colunas is None or nome in colunas]
+    tipos = {coluna: dtype[nomes[coluna]] for coluna in usecols if dtype and nomes[coluna] in dtype}
+    if MOTOR_CSV == "pyarrow":
+        df = _ler_csv_pyarrow(caminho_arquivo, formato, usecols, tipos)
+    else:
+        df = pd.read_csv(caminho_arquivo, sep=formato["sep"], encoding=formato["encoding"], engine="c",
+                         usecols=usecols, dtype=tipos or None)
+    return df.rename(columns=nomes)
+
+def _ler_csv_pyarrow(caminho_arquivo, formato, usecols, tipos):
+    # pyarrow.csv é usado diretamente (e não via engine="pyarrow" do pandas) porque o pandas só
+    # aplica o dtype depois da inferência, transformando códigos como "3.10" em "3.1".
+    import pyarrow as pa
+    from pyarrow import csv as pa_csv
+    tipos_arrow = {coluna: pa.string() if tipo is str else pa.from_numpy_dtype(np.dtype(tipo)) for coluna, tipo in tipos.items()}
+    tabela = pa_csv.read_csv(
+        caminho_arquivo,
+        read_options=pa_csv.ReadOptions(encoding=formato["encoding"]),
+        parse_options=pa_csv.ParseOptions(delimiter=formato["sep"]),
+        convert_options=pa_csv.ConvertOptions(include_columns=usecols, column_types=tipos_arrow, strings_can_be_null=True),
+    )
+    return tabela.to_pandas()
+
+def carregar_arrow_mapeado(caminho_arrow, caminho_csv):
+    """
+    Abre por memory-map a cópia Arrow gerada pelo update_data.py, se ela não for mais antiga que o CSV.
+    As colunas numéricas apontam direto para as páginas do arquivo (somente leitura), que o sistema
+    operacional compartilha entre os workers; só os códigos das colunas categóricas são copiados.
+    """
+    if not caminho_arrow.exists():
+        return None
+    if caminho_csv.exists() and caminho_arrow.stat().st_mtime < caminho_csv.stat().st_mtime:
+        logging.warning(f"'{caminho_arrow.name}' está desatualizado em relação ao CSV; usando o CSV.")
+        return None
+    try:
+        from pyarrow import feather
+        tabela = feather.read_table(caminho_arrow, columns=sorted(_COLUNAS_METRICAS), memory_map=True)
+        return tabela.to_pandas(split_blocks=True)
+    except Exception as e:
+        logging.warning(f"Falha ao ler '{caminho_arrow.name}', usando o CSV. Erro: {e}")
+        return None
+
+def compactar_demonstrativo(df):
+    """Converte um demonstrativo lido do CSV para a representação da cópia Arrow (códigos categóricos e datas)."""
+    return df.assign(
+        CD_CVM=pd.to_numeric(df["CD_CVM"], errors="coerce").astype("Int64"),
+        DT_REFER=pd.to_datetime(df["DT_REFER"], errors="coerce"),
+        VL_CONTA=pd.to_numeric(df["VL_CONTA"], errors="coerce"),
+        CD_CONTA=df["CD_CONTA"].astype("category"),
+        ORDEM_EXERC=df["ORDEM_EXERC"].astype("category"),
+    )
 
 @lru_cache(maxsize=1)
 def carregar_mapeamento_ticker_cvm():
@@ -57,9 +311,8 @@ def carregar_mapeamento_ticker_cvm():
     try:
         if not caminho_arquivo.exists():
             raise FileNotFoundError(f"Arquivo de mapeamento '{caminho_arquivo.name}' não encontrado.")
-        df = carregar_csv_robusto(caminho_arquivo, header=0, dtype=str)
-        df.columns = [str(col).strip().upper() for col in df.columns]
         required = ["CD_CVM", "TICKER", "NOME_EMPRESA"]
+        df = carregar_csv_rapido(caminho_arquivo, colunas=set(required), dtype=dict.fromkeys(required, str))
         if not all(col in df.columns for col in required):
             raise ValueError(f"As colunas necessárias {required} não foram encontradas.")
         df = df[required].copy()
@@ -71,6 +324,105 @@ def carregar_mapeamento_ticker_cvm():
         logging.error(f"Erro CRÍTICO ao carregar mapeamento de tickers: {e}", exc_info=True)
         return None, str(e)
 
+_COLUNAS_METRICAS = {"CD_CVM", "CD_CONTA", "ORDEM_EXERC", "DT_REFER", "VL_CONTA"}
+_TIPOS_COLUNAS_METRICAS = {"CD_CVM": "float64", "CD_CONTA": str, "ORDEM_EXERC": str, "DT_REFER": str, "VL_CONTA": "float64"}
+# Os valores dos demonstrativos da CVM estão em milhares de reais
+ESCALA_VL_CONTA = 1000
+
+def _metricas_ultimo_exercicio(df, contas):
+    """Filtra as linhas "ÚLTIMO" das contas informadas, com DT_REFER convertido e ordenado."""
+    metricas = df[(df["ORDEM_EXERC"] == "ÚLTIMO") & df["CD_CONTA"].isin(contas) & df["CD_CVM"].notna()]
+    metricas = metricas.assign(
+        DT_REFER=pd.to_datetime(metricas["DT_REFER"]), CD_CONTA=metricas["CD_CONTA"].astype(str),
+        VL_CONTA=metricas["VL_CONTA"].fillna(0) * ESCALA_VL_CONTA,
+    )
+    return metricas.sort_values("DT_REFER", kind="mergesort")
+
+def construir_indice_demonstrativos(demonstrativos):
+    """
+    Pré-indexa as séries "ÚLTIMO" das contas usadas no valuation.
+
+    Retorna {tipo: {CD_CVM: {CD_CONTA: série}}}, com as séries já indexadas por DT_REFER e
+    ordenadas. Toda empresa presente no demonstrativo tem uma entrada, mesmo sem contas relevantes.
+    """
+    contas = set(CONFIG["CONTAS_CVM"].values())
+    indice = {}
+    for tipo, df in demonstrativos.items():
+        if df.empty or not _COLUNAS_METRICAS.issubset(df.columns):
+            indice[tipo] = {}
+            continue
+        indice_tipo = {codigo_cvm: {} for codigo_cvm in df["CD_CVM"].dropna().unique()}
+        metricas = _metricas_ultimo_exercicio(df, contas)
+        for (codigo_cvm, codigo_conta), grupo in metricas.groupby(["CD_CVM", "CD_CONTA"], sort=False):
+            indice_tipo[codigo_cvm][codigo_conta] = grupo.set_index("DT_REFER")["VL_CONTA"]
+        indice[tipo] = indice_tipo
+    return indice
+
+def construir_fundamentos(demonstrativos):
+    """
+    Monta a matriz empresa x conta usada pelo valuation vetorizado.
+
+    Cada coluna de CONTAS_CVM traz o valor mais recente da conta (0 se ausente; EBIT fica NaN),
+    e IMPOSTO_TOTAL / LAIR_TOTAL trazem a soma do histórico, como no cálculo escalar.
+    Só entram empresas presentes na DRE, no BPA e no BPP.
+    """
+    C = CONFIG["CONTAS_CVM"]
+    empresas = None
+    recentes, somas = [], []
+    for tipo in ["dre", "bpa", "bpp"]:
+        df = demonstrativos[tipo]
+        if df.empty or not _COLUNAS_METRICAS.issubset(df.columns):
+            return pd.DataFrame(columns=list(C) + ["IMPOSTO_TOTAL", "LAIR_TOTAL"])
+        presentes = pd.Index(df["CD_CVM"].dropna().unique())
+        empresas = presentes if empresas is None else empresas.intersection(presentes, sort=False)
+        contas = {C[nome]: nome for nome, origem in CONFIG["ORIGEM_CONTAS_CVM"].items() if origem == tipo}
+        valores = _metricas_ultimo_exercicio(df, contas).groupby(["CD_CVM", "CD_CONTA"])["VL_CONTA"]
+        recentes.append(valores.last().unstack().rename(columns=contas))
+        somas.append(valores.sum().unstack().rename(columns=contas))
+
+    recentes = pd.concat(recentes, axis=1).reindex(index=empresas, columns=list(C))
+    somas = pd.concat(somas, axis=1).reindex(index=empresas, columns=list(C))
+    fundamentos = recentes.drop(columns="EBIT").fillna(0)
+    fundamentos.insert(0, "EBIT", recentes["EBIT"])
+    fundamentos["IMPOSTO_TOTAL"] = somas["IMPOSTO_DE_RENDA_CSLL"].fillna(0)
+    fundamentos["LAIR_TOTAL"] = somas["LUCRO_ANTES_IMPOSTOS"].fillna(0)
+    fundamentos.index.name = "CD_CVM"
+    return fundamentos
+
+def construir_fundamentos_historicos(demonstrativos):
+    """
+    Versão por exercício de construir_fundamentos: uma linha por (CD_CVM, DT_REFER).
+
+    Cada conta traz o valor mais recente disponível até a data (0 se ainda não houver; EBIT fica
+    NaN) e IMPOSTO_TOTAL / LAIR_TOTAL trazem a soma acumulada do histórico até a data, de modo
+    que a última linha de cada empresa coincide com construir_fundamentos.
+    """
+    C = CONFIG["CONTAS_CVM"]
+    colunas = list(C) + ["IMPOSTO_TOTAL", "LAIR_TOTAL"]
+    empresas = None
+    valores, somas = [], []
+    for tipo in ["dre", "bpa", "bpp"]:
+        df = demonstrativos[tipo]
+        if df.empty or not _COLUNAS_METRICAS.issubset(df.columns):
+            return pd.DataFrame(columns=["CD_CVM", "DT_REFER"] + colunas)
+        presentes = pd.Index(df["CD_CVM"].dropna().unique())
+        empresas = presentes if empresas is None else empresas.intersection(presentes, sort=False)
+        contas = {C[nome]: nome for nome, origem in CONFIG["ORIGEM_CONTAS_CVM"].items() if origem == tipo}
+        por_data = _metricas_ultimo_exercicio(df, contas).groupby(["CD_CVM", "DT_REFER", "CD_CONTA"])["VL_CONTA"]
+        valores.append(por_data.last().unstack().rename(columns=contas))
+        somas.append(por_data.sum().unstack().rename(columns=contas))
+
+    valores = pd.concat(valores, axis=1).reindex(columns=list(C))
+    valores = valores[valores.index.get_level_values("CD_CVM").isin(empresas)].sort_index()
+    somas = pd.concat(somas, axis=1).reindex(index=valores.index, columns=list(C))
+    valores = valores.groupby(level="CD_CVM").ffill()
+
+    historico = valores.drop(columns="EBIT").fillna(0)
+    historico.insert(0, "EBIT", valores["EBIT"])
+    historico["IMPOSTO_TOTAL"] = somas["IMPOSTO_DE_RENDA_CSLL"].fillna(0).groupby(level="CD_CVM").cumsum()
+    historico["LAIR_TOTAL"] = somas["LUCRO_ANTES_IMPOSTOS"].fillna(0).groupby(level="CD_CVM").cumsum()
+    return historico.reset_index()
+
 @lru_cache(maxsize=4)
 def carregar_dados_preparados():
     try:
@@ -78,43 +430,133 @@ def carregar_dados_preparados():
         tipos_necessarios = ["dre", "bpa", "bpp", "dfc_mi"]
         for tipo in tipos_necessarios:
             caminho_arquivo = CONFIG["DIRETORIO_DADOS_CONSOLIDADOS"] / f"{tipo}_consolidado.csv"
-            if not caminho_arquivo.exists():
-                if tipo == "dfc_mi":
-                    demonstrativos[tipo] = pd.DataFrame()
-                    continue
-                raise FileNotFoundError(f"Arquivo de dados essencial não encontrado: {caminho_arquivo.name}.")
-            df = carregar_csv_robusto(caminho_arquivo, dtype={"CD_CONTA": str})
-            if "CD_CVM" in df.columns:
-                df["CD_CVM"] = pd.to_numeric(df["CD_CVM"], errors="coerce").astype("Int64")
-            if "VL_CONTA" in df.columns:
-                df["VL_CONTA"] = pd.to_numeric(df["VL_CONTA"], errors="coerce").fillna(0) * 1000
+            df = carregar_arrow_mapeado(caminho_arquivo.with_suffix(".arrow"), caminho_arquivo)
+            if df is None:
+                if not caminho_arquivo.exists():
+                    if tipo == "dfc_mi":
+                        demonstrativos[tipo] = pd.DataFrame()
+                        continue
+                    raise FileNotFoundError(f"Arquivo de dados essencial não encontrado: {caminho_arquivo.name}.")
+                df = carregar_csv_rapido(caminho_arquivo, colunas=_COLUNAS_METRICAS, dtype=_TIPOS_COLUNAS_METRICAS)
+                if _COLUNAS_METRICAS.issubset(df.columns):
+                    df = compactar_demonstrativo(df)
             demonstrativos[tipo] = df
+        demonstrativos["indice"] = construir_indice_demonstrativos(demonstrativos)
+        demonstrativos["fundamentos"] = construir_fundamentos(demonstrativos)
         return demonstrativos, None
     except Exception as e:
         logging.error(f"Erro CRÍTICO ao carregar dados consolidados: {e}", exc_info=True)
         return None, f"Erro ao carregar arquivos de dados consolidados: {e}"
 
-@lru_cache(maxsize=1)
+def buscar_ultimo_valor_bcb(codigo_serie):
+    """Retorna o último registro ({"data", "valor"}) de uma série SGS do BCB, com cache em disco."""
+    def carregar():
+        url = f"https://api.bcb.gov.br/dados/serie/bcdata.sgs.{codigo_serie}/dados/ultimos/1?formato=json"
+        return CLIENTE_HTTP.obter_json(url)[0]
+    return obter_com_cache("bcb", codigo_serie, carregar)
+
+def buscar_ultimos_valores_bcb(codigos_series):
+    """
+    Busca de uma vez o último registro de várias séries SGS. A API JSON do SGS atende uma série
+    por URL, então as séries fora do cache são pedidas em paralelo pela mesma sessão keep-alive.
+    Retorna {codigo: (registro, erro)}.
+    """
+    with ThreadPoolExecutor(max_workers=max(1, len(codigos_series)), thread_name_prefix="bcb") as executor:
+        futuros = {codigo: executor.submit(buscar_ultimo_valor_bcb, codigo) for codigo in codigos_series}
+    resultados = {}
+    for codigo, futuro in futuros.items():
+        try:
+            resultados[codigo] = (futuro.result(), None)
+        except Exception as e:
+            resultados[codigo] = (None, e)
+    return resultados
+
+def _registro_bcb(series, codigo):
+    registro, erro = series[codigo]
+    if erro is not None:
+        raise erro
+    return registro
+
+def _tickers_sem_precos(dados, tickers):
+    """Tickers sem nenhum fechamento no download (o yfinance devolve NaN quando um ticker falha)."""
+    lista = [tickers] if isinstance(tickers, str) else list(tickers)
+    if dados.empty:
+        return lista
+    fechamentos = _extrair_fechamentos(dados, lista, "Close").reindex(columns=lista)
+    return [ticker for ticker in lista if fechamentos[ticker].isna().all()]
+
+def _download_yahoo(tickers, **kwargs):
+    """
+    yf.download sob o limite de taxa e as novas tentativas do CLIENTE_HTTP. O yfinance faz uma
+    requisição por ticker e não levanta exceção quando um deles falha (devolve a coluna vazia),
+    então cada tentativa consome uma ficha por ticker e, se algum vier sem preços, só esses são
+    baixados de novo após o backoff. Na última tentativa devolve o que foi obtido.
+    """
+    estado = {"dados": None, "pendentes": [tickers] if isinstance(tickers, str) else list(tickers), "tentativa": 0}
+
+    def baixar():
+        estado["tentativa"] += 1
+        alvo = tickers if isinstance(tickers, str) else estado["pendentes"]
+        dados = yf.download(alvo, period=CONFIG["PERIODO_BETA_IBOV"], progress=False, timeout=15,
+                            auto_adjust=False, threads=CONFIG["YAHOO_THREADS_DOWNLOAD"], **kwargs)
+        anteriores = estado["dados"]
+        if anteriores is None or anteriores.empty or isinstance(tickers, str):
+            estado["dados"] = dados
+        elif not dados.empty and isinstance(dados.columns, pd.MultiIndex):
+            combinados = pd.concat([anteriores.drop(columns=alvo, level=-1, errors="ignore"), dados], axis=1)
+            estado["dados"] = combinados.sort_index(axis=1, level=0, sort_remaining=False)
+        estado["pendentes"] = _tickers_sem_precos(dados, alvo)
+        if estado["pendentes"]:
+            mensagem = f"{len(estado['pendentes'])} tickers sem preços no download do Yahoo (tentativa {estado['tentativa']})."
+            if estado["tentativa"] < CLIENTE_HTTP.tentativas:
+                raise ErroTransitorio(mensagem)
+            logging.warning(f"{mensagem} Seguindo com os preços obtidos.")
+        return estado["dados"]
+
+    chave_tickers = tickers if isinstance(tickers, str) else tuple(tickers)
+    return CLIENTE_HTTP.executar(HOST_YAHOO, baixar, chave=("precos", chave_tickers, tuple(sorted(kwargs.items()))),
+                                 fichas=lambda: len(estado["pendentes"]))
+
+def baixar_precos(tickers, **kwargs):
+    """
+    yf.download de fechamentos com cache em disco. Downloads vazios, ou em que algum ticker veio
+    sem preços (falha ou throttling do Yahoo), não são cacheados.
+    """
+    chave_tickers = tickers if isinstance(tickers, str) else hashlib.sha1(",".join(tickers).encode()).hexdigest()
+    # Os argumentos do yf.download (ex.: start/end) entram na chave, como na coalescência do _download_yahoo
+    chave = f"{CONFIG['PERIODO_BETA_IBOV']}:{chave_tickers}:{sorted(kwargs.items())}"
+    def carregar():
+        dados = _download_yahoo(tickers, **kwargs)
+        if dados.empty:
+            raise ValueError(f"Download de preços vazio para {tickers}.")
+        return dados
+    try:
+        return obter_com_cache("precos", chave, carregar,
+                               pode_gravar=lambda dados: not _tickers_sem_precos(dados, tickers))
+    except ValueError:
+        return pd.DataFrame()
+
 def obter_dados_mercado():
     """Obtém premissas de mercado (taxa livre de risco, prêmio) e dados do IBOV para cálculo do Beta."""
     dados = {"risk_free_rate": 0.105, "premio_risco_mercado": 0.08, "cresc_perpetuo": 0.03}
-    
+
+    # As séries do BCB (SELIC, IPCA, câmbio) e o IBOV são independentes: busca tudo ao mesmo tempo
+    with ThreadPoolExecutor(max_workers=2, thread_name_prefix="mercado") as executor:
+        futuro_series = executor.submit(buscar_ultimos_valores_bcb, (432, 433, 1))
+        futuro_ibov = executor.submit(baixar_precos, "^BVSP")
+    series_bcb = futuro_series.result()
+
     # Fetch SELIC (Risk-Free Rate)
     try:
-        selic_url = "https://api.bcb.gov.br/dados/serie/bcdata.sgs.432/dados/ultimos/1?formato=json"
-        response = requests.get(selic_url, timeout=10)
-        response.raise_for_status()
-        selic_value = float(response.json()[0]["valor"])
+        selic_value = float(_registro_bcb(series_bcb, 432)["valor"])
         dados["risk_free_rate"] = selic_value / 100.0
     except Exception as e:
         logging.warning(f"Não foi possível obter a SELIC do BCB. Erro: {e}")
+        METRICAS.incrementar("fallbacks_total", tipo="premissa_padrao", motivo="selic")
 
     # Fetch IPCA (Inflation)
     try:
-        ipca_url = "https://api.bcb.gov.br/dados/serie/bcdata.sgs.433/dados/ultimos/1?formato=json"
-        response = requests.get(ipca_url, timeout=10)
-        response.raise_for_status()
-        ipca_data = response.json()[0]
+        ipca_data = _registro_bcb(series_bcb, 433)
         # Formata a data para o padrão brasileiro
         data_obj = datetime.strptime(ipca_data['data'], '%d/%m/%Y')
         mes_ano = data_obj.strftime('%m/%Y')
@@ -125,10 +567,7 @@ def obter_dados_mercado():
 
     # Fetch Exchange Rate (Dolar)
     try:
-        cambio_url = "https://api.bcb.gov.br/dados/serie/bcdata.sgs.1/dados/ultimos/1?formato=json"
-        response = requests.get(cambio_url, timeout=10)
-        response.raise_for_status()
-        cambio_data = response.json()[0]
+        cambio_data = _registro_bcb(series_bcb, 1)
         dados["cambio_dolar"] = f"R$ {float(cambio_data['valor'])}"
     except Exception as e:
         logging.warning(f"Não foi possível obter o Câmbio do BCB. Erro: {e}")
@@ -136,60 +575,168 @@ def obter_dados_mercado():
 
     # Fetch IBOV data
     try:
-        dados["ibov_data"] = yf.download("^BVSP", period=CONFIG["PERIODO_BETA_IBOV"], progress=False, timeout=15)
+        dados["ibov_data"] = futuro_ibov.result()
         if dados["ibov_data"].empty:
             raise ValueError("Download do IBOV retornou um DataFrame vazio.")
     except Exception as e:
         logging.error(f"Falha ao baixar dados do IBOV. O cálculo do Beta usará o valor padrão 1.0. Erro: {e}")
         dados["ibov_data"] = pd.DataFrame() 
+        METRICAS.incrementar("fallbacks_total", tipo="ibov_indisponivel")
     return dados
 
-def obter_valor_recente(df_empresa, codigo_conta):
-    historico = obter_historico_metrica(df_empresa, codigo_conta)
+def obter_valor_recente(series_empresa, codigo_conta):
+    historico = obter_historico_metrica(series_empresa, codigo_conta)
     return historico.iloc[-1] if not historico.empty else 0
 
-def obter_historico_metrica(df_empresa, codigo_conta):
-    metric_df = df_empresa[(df_empresa["CD_CONTA"] == codigo_conta) & (df_empresa["ORDEM_EXERC"] == "ÚLTIMO")]
-    if metric_df.empty:
-        return pd.Series(dtype=float)
-    metric_df = metric_df.copy()
-    metric_df["DT_REFER"] = pd.to_datetime(metric_df["DT_REFER"])
-    return metric_df.set_index("DT_REFER")["VL_CONTA"].sort_index()
+def obter_historico_metrica(series_empresa, codigo_conta):
+    """Retorna a série histórica (pré-indexada) de uma conta para a empresa."""
+    historico = series_empresa.get(codigo_conta)
+    return historico if historico is not None else pd.Series(dtype=float)
+
+def _beta_padrao(motivo, quantidade=1):
+    """Registra o uso do beta padrão 1.0 e o devolve."""
+    if quantidade:
+        METRICAS.incrementar("fallbacks_total", quantidade, tipo="beta_padrao", motivo=motivo)
+    return 1.0
 
 def calcular_beta(ticker, ibov_data):
-    if ibov_data.empty: return 1.0
+    if ibov_data.empty: return _beta_padrao("sem_ibov")
     try:
-        dados_acao = yf.download(ticker, period=CONFIG["PERIODO_BETA_IBOV"], progress=False, timeout=15)
-        if dados_acao.empty or len(dados_acao) < 60: return 1.0
+        dados_acao = baixar_precos(ticker)
+        if dados_acao.empty or len(dados_acao) < 60: return _beta_padrao("poucos_precos")
         dados_combinados = pd.concat([dados_acao["Adj Close"], ibov_data["Adj Close"]], axis=1).dropna()
         retornos = dados_combinados.pct_change().dropna()
-        if len(retornos) < 50: return 1.0
+        if len(retornos) < 50: return _beta_padrao("poucos_retornos")
         retornos.columns = ['Acao', 'Ibov']
         slope, _, _, _, _ = stats.linregress(retornos['Ibov'], retornos['Acao'])
         beta_ajustado = 0.67 * slope + 0.33 * 1.0
-        return beta_ajustado if not np.isnan(beta_ajustado) else 1.0
-    except Exception:
-        return 1.0
+        return beta_ajustado if not np.isnan(beta_ajustado) else _beta_padrao("regressao_invalida")
+    except Exception as e:
+        logging.warning(f"Falha ao calcular o beta de {ticker}; usando 1.0. Erro: {e}")
+        return _beta_padrao("erro")
 
-def processar_valuation_empresa(ticker_sa, codigo_cvm, demonstrativos, market_data):
-    try:
-        dre, bpa, bpp = demonstrativos["dre"], demonstrativos["bpa"], demonstrativos["bpp"]
-        empresa_dre = dre[dre["CD_CVM"] == codigo_cvm]
-        empresa_bpa = bpa[bpa["CD_CVM"] == codigo_cvm]
-        empresa_bpp = bpp[bpp["CD_CVM"] == codigo_cvm]
+def _extrair_fechamentos(dados, tickers, campo="Adj Close"):
+    """Extrai os fechamentos (datas x tickers) de um download do yfinance."""
+    fechamentos = dados[campo]
+    if isinstance(fechamentos, pd.Series):
+        fechamentos = fechamentos.to_frame(name=tickers[0])
+    return fechamentos
+
+def calcular_betas_vetorizados(precos, ibov):
+    """Calcula os betas ajustados de Blume de todas as colunas de `precos` contra o IBOV.
+
+    Reproduz calcular_beta coluna a coluna: cada ação usa apenas as datas em que ela e o
+    IBOV têm cotação, exige 60 preços e 50 retornos e devolve 1.0 nos demais casos.
+    """
+    if isinstance(ibov, pd.DataFrame):
+        ibov = ibov.iloc[:, 0]
+    precos, ibov = precos.align(ibov, join="outer", axis=0)
+    matriz_precos = precos.to_numpy(dtype=float)
+    matriz_ibov = np.broadcast_to(ibov.to_numpy(dtype=float)[:, None], matriz_precos.shape)
+
+    validos = ~np.isnan(matriz_precos) & ~np.isnan(matriz_ibov)
+    precos_validos = np.where(validos, matriz_precos, np.nan)
+    ibov_validos = np.where(validos, matriz_ibov, np.nan)
+    # Preço anterior de cada coluna considerando apenas as datas válidas daquela ação
+    anteriores_precos = pd.DataFrame(precos_validos).ffill().shift(1).to_numpy()
+    anteriores_ibov = pd.DataFrame(ibov_validos).ffill().shift(1).to_numpy()
 
-        if any(df.empty for df in [empresa_dre, empresa_bpa, empresa_bpp]): return None
+    retornos_acao = precos_validos / anteriores_precos - 1
+    retornos_ibov = ibov_validos / anteriores_ibov - 1
+    mascara = ~np.isnan(retornos_acao) & ~np.isnan(retornos_ibov)
+    n_retornos = mascara.sum(axis=0)
 
-        info = yf.Ticker(ticker_sa).info
-        market_cap = info.get("marketCap")
-        preco_atual = info.get("currentPrice", info.get("previousClose"))
-        n_acoes = info.get("sharesOutstanding")
+    with np.errstate(divide="ignore", invalid="ignore"):
+        media_acao = np.where(mascara, retornos_acao, 0).sum(axis=0) / n_retornos
+        media_ibov = np.where(mascara, retornos_ibov, 0).sum(axis=0) / n_retornos
+        desvio_acao = np.where(mascara, retornos_acao - media_acao, 0)
+        desvio_ibov = np.where(mascara, retornos_ibov - media_ibov, 0)
+        slope = (desvio_acao * desvio_ibov).sum(axis=0) / (desvio_ibov ** 2).sum(axis=0)
 
-        if not all([market_cap, preco_atual, n_acoes, n_acoes > 0, market_cap > 0]): return None
+    beta_ajustado = 0.67 * slope + 0.33 * 1.0
+    precos_suficientes = np.count_nonzero(~np.isnan(matriz_precos), axis=0) >= 60
+    suficiente = precos_suficientes & (n_retornos >= 50)
+    _beta_padrao("poucos_precos", int((~precos_suficientes).sum()))
+    _beta_padrao("poucos_retornos", int((precos_suficientes & ~suficiente).sum()))
+    _beta_padrao("regressao_invalida", int((suficiente & ~np.isfinite(beta_ajustado)).sum()))
+    betas = np.where(suficiente & np.isfinite(beta_ajustado), beta_ajustado, 1.0)
+    return dict(zip(precos.columns, betas.tolist()))
+
+def baixar_fechamentos_em_lote(tickers, campo="Adj Close"):
+    """
+    Baixa os fechamentos de todos os tickers em lotes de CONFIG["TAMANHO_LOTE_BETA"] (datas x tickers).
+    Os lotes são os mesmos para qualquer `campo`, de modo que o cache de preços é reaproveitado.
+    """
+    tamanho_lote = CONFIG["TAMANHO_LOTE_BETA"]
+    blocos = []
+    for inicio in range(0, len(tickers), tamanho_lote):
+        lote = list(tickers[inicio:inicio + tamanho_lote])
+        try:
+            dados = baixar_precos(lote, group_by="column")
+            if not dados.empty:
+                blocos.append(_extrair_fechamentos(dados, lote, campo))
+        except Exception as e:
+            logging.warning(f"Falha no download em lote de {len(lote)} tickers. Erro: {e}")
+    if not blocos:
+        return pd.DataFrame()
+    precos = pd.concat(blocos, axis=1)
+    return precos.loc[:, ~precos.columns.duplicated()]
+
+def calcular_betas_em_lote(tickers, ibov_data):
+    """Baixa os preços de todos os tickers em lotes e calcula os betas numa única passada."""
+    betas = {ticker: 1.0 for ticker in tickers}
+    if ibov_data.empty or not tickers:
+        _beta_padrao("sem_ibov", len(tickers))
+        return betas
+
+    precos = baixar_fechamentos_em_lote(tickers)
+    if precos.empty:
+        _beta_padrao("sem_precos", len(tickers))
+        return betas
+    calculados = calcular_betas_vetorizados(precos, ibov_data["Adj Close"])
+    calculados = {ticker: beta for ticker, beta in calculados.items() if ticker in betas}
+    _beta_padrao("sem_precos", len(betas) - len(calculados))
+    betas.update(calculados)
+    logging.info(f"Betas calculados em lote para {len(precos.columns)} de {len(tickers)} tickers.")
+    return betas
+
+def obter_dados_cotacao(ticker_sa):
+    """Obtém do yfinance valor de mercado, preço, nº de ações e nome. Retorna None se incompletos."""
+    info = obter_com_cache("cotacao", ticker_sa, lambda: CLIENTE_HTTP.executar(
+        HOST_YAHOO, lambda: yf.Ticker(ticker_sa).info, chave=("cotacao", ticker_sa)))
+    market_cap = info.get("marketCap")
+    preco_atual = info.get("currentPrice", info.get("previousClose"))
+    n_acoes = info.get("sharesOutstanding")
+
+    if not all([market_cap, preco_atual, n_acoes]) or n_acoes <= 0 or market_cap <= 0: return None
+    return {
+        "market_cap": market_cap, "preco_atual": preco_atual, "n_acoes": n_acoes,
+        "nome": info.get('shortName', ticker_sa.replace('.SA', ''))[:30],
+    }
+
+def descartar_empresa(motivo, quantidade=1):
+    """Registra o motivo pelo qual empresas ficaram fora do resultado e devolve None."""
+    if quantidade:
+        METRICAS.incrementar("empresas_descartadas_total", quantidade, motivo=motivo)
+    return None
+
+def processar_valuation_empresa(ticker_sa, codigo_cvm, demonstrativos, market_data, betas=None):
+    try:
+        indice = demonstrativos["indice"]
+        empresa_dre = indice["dre"].get(codigo_cvm)
+        empresa_bpa = indice["bpa"].get(codigo_cvm)
+        empresa_bpp = indice["bpp"].get(codigo_cvm)
+
+        if any(series is None for series in [empresa_dre, empresa_bpa, empresa_bpp]):
+            return descartar_empresa("sem_demonstrativos")
+
+        cotacao = obter_dados_cotacao(ticker_sa)
+        if cotacao is None: return descartar_empresa("sem_cotacao")
+        market_cap, preco_atual, n_acoes = cotacao["market_cap"], cotacao["preco_atual"], cotacao["n_acoes"]
 
         C = CONFIG["CONTAS_CVM"]
         hist_ebit = obter_historico_metrica(empresa_dre, C["EBIT"])
-        if hist_ebit.empty or hist_ebit.iloc[-1] == 0: return None
+        if hist_ebit.empty or hist_ebit.iloc[-1] == 0: return descartar_empresa("ebit_invalido")
 
         imposto_total = obter_historico_metrica(empresa_dre, C["IMPOSTO_DE_RENDA_CSLL"]).sum()
         lucro_antes_ir = obter_historico_metrica(empresa_dre, C["LUCRO_ANTES_IMPOSTOS"]).sum()
@@ -205,10 +752,13 @@ def processar_valuation_empresa(ticker_sa, codigo_cvm, demonstrativos, market_da
         ativo_nao_circulante = obter_valor_recente(empresa_bpa, C["ATIVO_NAO_CIRCULANTE"])
         capital_empregado = ncg + ativo_nao_circulante
 
-        if capital_empregado <= 0: return None
+        if capital_empregado <= 0: return descartar_empresa("capital_empregado_nao_positivo")
 
         roic = nopat_recente / capital_empregado
-        beta = calcular_beta(ticker_sa, market_data["ibov_data"])
+        if betas is not None and ticker_sa in betas:
+            beta = betas[ticker_sa]
+        else:
+            beta = calcular_beta(ticker_sa, market_data["ibov_data"])
         ke = market_data["risk_free_rate"] + beta * market_data["premio_risco_mercado"]
 
         divida_total = (obter_valor_recente(empresa_bpp, C["DIVIDA_CURTO_PRAZO"]) + 
@@ -220,16 +770,17 @@ def processar_valuation_empresa(ticker_sa, codigo_cvm, demonstrativos, market_da
             kd = min(kd_calculado, 0.35) 
         else:
             kd = ke * 0.7
+            METRICAS.incrementar("fallbacks_total", tipo="kd_estimado")
 
         valor_total = market_cap + divida_total
-        if valor_total <= 0: return None
+        if valor_total <= 0: return descartar_empresa("valor_total_nao_positivo")
             
         w_e = market_cap / valor_total
         w_d = divida_total / valor_total
         wacc = (w_e * ke) + (w_d * kd * (1 - aliquota_efetiva))
 
         g = market_data["cresc_perpetuo"]
-        if wacc <= g: return None
+        if wacc <= g: return descartar_empresa("wacc_menor_ou_igual_g")
 
         eva = (roic - wacc) * capital_empregado
         valor_firma = capital_empregado + (eva * (1 + g)) / (wacc - g)
@@ -247,7 +798,7 @@ def processar_valuation_empresa(ticker_sa, codigo_cvm, demonstrativos, market_da
         efv_percent = efv / market_cap if market_cap > 0 else 0.0
 
         return {
-            'Nome': info.get('shortName', ticker_sa.replace('.SA', ''))[:30], 
+            'Nome': cotacao["nome"], 
             'Ticker': ticker_sa.replace('.SA', ''),
             'Upside': upside, 'ROIC': roic, 'WACC': wacc, 'Spread': roic - wacc,
             'EVA_percent': eva_percent, 'EFV_percent': efv_percent,
@@ -255,8 +806,281 @@ def processar_valuation_empresa(ticker_sa, codigo_cvm, demonstrativos, market_da
             'Market_Cap': market_cap, 'EVA': eva,
             'Capital_Empregado': capital_empregado, 'NOPAT': nopat_recente
         }
-    except Exception:
-        return None
+    except Exception as e:
+        logging.warning(f"Erro no valuation de {ticker_sa}: {e}")
+        return descartar_empresa("erro")
+
+# Colunas numéricas das entradas do valuation vetorizado (além das de construir_fundamentos)
+COLUNAS_MERCADO_VALUATION = ["market_cap", "preco_atual", "n_acoes", "beta"]
+
+def _nucleo_valuation(e, risk_free_rate, premio_risco_mercado, cresc_perpetuo, ajuste_beta=0.0):
+    """
+    Fórmulas do valuation vetorizado sobre arrays NumPy.
+
+    `e` mapeia cada coluna das entradas para um array; as premissas podem ser escalares ou
+    arrays que façam broadcast com elas (ex.: entradas (N, 1) contra uma grade (1, K)).
+    Devolve os arrays intermediários e as máscaras dos descartes de processar_valuation_empresa.
+    """
+    g = cresc_perpetuo
+    with np.errstate(divide="ignore", invalid="ignore"):
+        aliquota_efetiva = np.where(e["LAIR_TOTAL"] != 0, np.abs(e["IMPOSTO_TOTAL"] / e["LAIR_TOTAL"]), 0.34)
+        aliquota_efetiva = np.clip(aliquota_efetiva, 0, 0.45)
+        nopat = e["EBIT"] * (1 - aliquota_efetiva)
+
+        ncg = e["CONTAS_A_RECEBER"] + e["ESTOQUES"] - e["FORNECEDORES"]
+        capital_empregado = ncg + e["ATIVO_NAO_CIRCULANTE"]
+        roic = nopat / capital_empregado
+        ke = risk_free_rate + (e["beta"] + ajuste_beta) * premio_risco_mercado
+
+        divida_total = e["DIVIDA_CURTO_PRAZO"] + e["DIVIDA_LONGO_PRAZO"]
+        despesa_financeira = np.abs(e["DESPESAS_FINANCEIRAS"])
+        kd_estimado = ~((divida_total > 0) & (despesa_financeira > 0))
+        kd = np.where(~kd_estimado, np.minimum(despesa_financeira / divida_total, 0.35), ke * 0.7)
+
+        valor_total = e["market_cap"] + divida_total
+        w_e = e["market_cap"] / valor_total
+        w_d = divida_total / valor_total
+        wacc = (w_e * ke) + (w_d * kd * (1 - aliquota_efetiva))
+
+        eva = (roic - wacc) * capital_empregado
+        valor_firma = capital_empregado + (eva * (1 + g)) / (wacc - g)
+        divida_liquida = divida_total - e["CAIXA_EQUIVALENTES"]
+        preco_justo = (valor_firma - divida_liquida) / e["n_acoes"]
+        upside = np.where(e["preco_atual"] > 0, (preco_justo / e["preco_atual"]) - 1, 0)
+
+        riqueza_atual = np.where(wacc > 0, eva / wacc, 0.0)
+        efv = (e["market_cap"] - capital_empregado) - riqueza_atual
+        efv_percent = np.where(e["market_cap"] > 0, efv / e["market_cap"], 0.0)
+
+    ebit_ok = ~np.isnan(e["EBIT"]) & (e["EBIT"] != 0)
+    capital_ok = ebit_ok & (capital_empregado > 0)
+    valor_total_ok = capital_ok & (valor_total > 0)
+    return {
+        "nopat": nopat, "capital_empregado": capital_empregado, "roic": roic, "wacc": wacc, "eva": eva,
+        "preco_justo": preco_justo, "upside": upside, "efv_percent": efv_percent, "kd_estimado": kd_estimado,
+        "ebit_ok": ebit_ok, "capital_ok": capital_ok, "valor_total_ok": valor_total_ok,
+        "validos": valor_total_ok & (wacc > g),
+    }
+
+def _arrays_entradas(entradas, formato=(-1,)):
+    colunas = list(CONFIG["CONTAS_CVM"]) + ["IMPOSTO_TOTAL", "LAIR_TOTAL"] + COLUNAS_MERCADO_VALUATION
+    return {coluna: entradas[coluna].to_numpy(dtype=float).reshape(formato) for coluna in colunas}
+
+def calcular_valuation_vetorizado(entradas, premissas, registrar_metricas=False):
+    """
+    Calcula EVA, WACC, preço justo e EFV de todas as empresas de uma vez.
+
+    `entradas` tem uma linha por ticker com as colunas de construir_fundamentos e os dados de
+    mercado (Ticker, Nome, CD_CVM, market_cap, preco_atual, n_acoes, beta). `premissas` traz
+    risk_free_rate, premio_risco_mercado e cresc_perpetuo. Aplica os mesmos descartes de
+    processar_valuation_empresa e devolve um DataFrame com as colunas do resultado escalar.
+    Com `registrar_metricas`, contabiliza os descartes e o uso do Kd estimado.
+    """
+    r = _nucleo_valuation(_arrays_entradas(entradas), premissas["risk_free_rate"],
+                          premissas["premio_risco_mercado"], premissas["cresc_perpetuo"])
+    if registrar_metricas:
+        descartar_empresa("ebit_invalido", int((~r["ebit_ok"]).sum()))
+        descartar_empresa("capital_empregado_nao_positivo", int((r["ebit_ok"] & ~r["capital_ok"]).sum()))
+        descartar_empresa("valor_total_nao_positivo", int((r["capital_ok"] & ~r["valor_total_ok"]).sum()))
+        descartar_empresa("wacc_menor_ou_igual_g", int((r["valor_total_ok"] & ~r["validos"]).sum()))
+        METRICAS.incrementar("fallbacks_total", int((r["kd_estimado"] & r["valor_total_ok"]).sum()), tipo="kd_estimado")
+    spread = r["roic"] - r["wacc"]
+    resultados = pd.DataFrame({
+        'Nome': entradas["Nome"], 'Ticker': entradas["Ticker"],
+        'Upside': r["upside"], 'ROIC': r["roic"], 'WACC': r["wacc"], 'Spread': spread,
+        'EVA_percent': spread, 'EFV_percent': r["efv_percent"],
+        'Preco_Atual': entradas["preco_atual"], 'Preco_Justo': r["preco_justo"],
+        'Market_Cap': entradas["market_cap"], 'EVA': r["eva"],
+        'Capital_Empregado': r["capital_empregado"], 'NOPAT': r["nopat"]
+    }, index=entradas.index)
+    return resultados[r["validos"]]
+
+DIMENSOES_SENSIBILIDADE = ["risk_free_rate", "premio_risco_mercado", "cresc_perpetuo", "ajuste_beta"]
+
+def calcular_grade_sensibilidade(entradas, grade):
+    """
+    Preço justo e upside de todas as empresas em todos os pontos de uma grade de premissas.
+
+    `grade` mapeia cada uma das DIMENSOES_SENSIBILIDADE para um array 1-D de valores
+    (ajuste_beta é somado ao beta de cada empresa). Os pontos são o produto cartesiano, na
+    ordem de DIMENSOES_SENSIBILIDADE (a última varia mais rápido). Tudo é calculado numa única
+    operação com broadcast (empresas x pontos). Retorna (preco_justo, upside) com formato
+    (n_empresas, n_pontos) e NaN onde o ponto é descartado (ex.: WACC <= g).
+    """
+    malha = np.meshgrid(*(np.asarray(grade[d], dtype=float) for d in DIMENSOES_SENSIBILIDADE), indexing="ij")
+    pontos = {d: m.reshape(1, -1) for d, m in zip(DIMENSOES_SENSIBILIDADE, malha)}
+    r = _nucleo_valuation(_arrays_entradas(entradas, (-1, 1)), pontos["risk_free_rate"],
+                          pontos["premio_risco_mercado"], pontos["cresc_perpetuo"], pontos["ajuste_beta"])
+    return np.where(r["validos"], r["preco_justo"], np.nan), np.where(r["validos"], r["upside"], np.nan)
+
+def montar_dados_mercado_empresas(empresas, betas, progresso=None):
+    """Busca as cotações em paralelo e devolve uma linha de dados de mercado por ticker com cotação."""
+    cotacoes = executar_em_paralelo(obter_dados_cotacao, [(ticker_sa,) for ticker_sa, _ in empresas], progresso=progresso)
+    linhas = [
+        {
+            "Ticker": ticker_sa.replace('.SA', ''), "Nome": cotacao["nome"], "CD_CVM": codigo_cvm,
+            "market_cap": cotacao["market_cap"], "preco_atual": cotacao["preco_atual"],
+            "n_acoes": cotacao["n_acoes"], "beta": betas.get(ticker_sa, 1.0),
+        }
+        for (ticker_sa, codigo_cvm), cotacao in zip(empresas, cotacoes) if cotacao is not None
+    ]
+    return pd.DataFrame(linhas, columns=["Ticker", "Nome", "CD_CVM", "market_cap", "preco_atual", "n_acoes", "beta"])
+
+def montar_entradas_valuation(empresas, fundamentos, betas, progresso=None):
+    """Junta fundamentos e dados de mercado (buscados em paralelo) numa linha por ticker."""
+    ebit = fundamentos["EBIT"]
+    com_ebit = set(ebit.index[ebit.notna() & (ebit != 0)])
+    candidatas = [(ticker_sa, codigo_cvm) for ticker_sa, codigo_cvm in empresas if codigo_cvm in com_ebit]
+    sem_demonstrativos = sum(1 for _, codigo_cvm in empresas if codigo_cvm not in fundamentos.index)
+    descartar_empresa("sem_demonstrativos", sem_demonstrativos)
+    descartar_empresa("ebit_invalido", len(empresas) - len(candidatas) - sem_demonstrativos)
+    if progresso is not None:
+        progresso["pulados"] += len(empresas) - len(candidatas)
+    mercado = montar_dados_mercado_empresas(candidatas, betas, progresso)
+    descartar_empresa("sem_cotacao", len(candidatas) - len(mercado))
+    return mercado.join(fundamentos, on="CD_CVM")
+
+def calcular_valuation_historico(fundamentos_historicos, mercado, fechamentos, premissas):
+    """
+    Calcula EVA, ROIC, WACC e preço justo de todas as empresas em todos os exercícios de uma vez.
+
+    `mercado` vem de montar_dados_mercado_empresas e `fechamentos` é a matriz datas x tickers
+    de preços não ajustados. Para cada exercício, o preço de referência é o último fechamento
+    até DT_REFER e o valor de mercado é esse preço vezes o número de ações atual; beta e
+    premissas são os atuais. Devolve as colunas de calcular_valuation_vetorizado com DT_REFER,
+    e Preco_Referencia no lugar de Preco_Atual.
+    """
+    entradas = mercado.drop(columns=["market_cap", "preco_atual"]).merge(fundamentos_historicos, on="CD_CVM")
+    preco_referencia = np.full(len(entradas), np.nan)
+    if not fechamentos.empty and not entradas.empty:
+        precos = fechamentos.sort_index().ffill()
+        if precos.index.tz is not None:
+            precos.index = precos.index.tz_localize(None)
+        linhas = precos.index.searchsorted(pd.DatetimeIndex(entradas["DT_REFER"]), side="right") - 1
+        colunas = precos.columns.get_indexer(entradas["Ticker"] + ".SA")
+        disponiveis = (linhas >= 0) & (colunas >= 0)
+        preco_referencia[disponiveis] = precos.to_numpy(dtype=float)[linhas[disponiveis], colunas[disponiveis]]
+    entradas["preco_atual"] = preco_referencia
+    entradas["market_cap"] = preco_referencia * entradas["n_acoes"]
+
+    resultados = calcular_valuation_vetorizado(entradas, premissas)
+    resultados.insert(2, "DT_REFER", entradas.loc[resultados.index, "DT_REFER"].dt.strftime("%Y-%m-%d"))
+    return resultados.rename(columns={"Preco_Atual": "Preco_Referencia"})
+
+def filtrar_resultados_extremos(resultados_brutos):
+    """Descarta resultados com WACC ou Upside fora das faixas de sanidade."""
+    resultados_filtrados = []
+    for r in resultados_brutos:
+        if r is None: continue
+        wacc_ok = 0.01 < r.get('WACC', 1) < 0.40
+        upside_ok = -0.99 < r.get('Upside', 0) < 10.0
+        if wacc_ok and upside_ok:
+            resultados_filtrados.append(r)
+        else:
+            descartar_empresa("valores_extremos")
+            logging.warning(f"Filtrando empresa {r['Ticker']} por resultados extremos: WACC={r.get('WACC', 'N/A'):.2%}, Upside={r.get('Upside', 'N/A'):.2%}")
+    return resultados_filtrados
+
+def _executar_medido(funcao, tarefa):
+    """Executa a tarefa e devolve (resultado, segundos), registrando a duração por função."""
+    with METRICAS.cronometrar("tarefa_segundos", funcao=funcao.__name__) as medicao:
+        resultado = funcao(*tarefa)
+    return resultado, medicao["segundos"]
+
+def _executar_com_limite_global(funcao, tarefa, inicios, indice):
+    with _SEMAFORO_TAREFAS:
+        # O prazo da tarefa conta a partir daqui, não do momento em que ela entrou na fila
+        inicios[indice] = time.monotonic()
+        return _executar_medido(funcao, tarefa)
+
+def _contabilizar(progresso, situacao, nome_tarefa=None, segundos=None):
+    METRICAS.incrementar("tarefas_total", situacao=situacao)
+    if progresso is None:
+        return
+    progresso[situacao] += 1
+    if segundos is not None:
+        # Mantém as tarefas mais lentas da execução para o resumo
+        mais_lentos = progresso.setdefault("mais_lentos", [])
+        mais_lentos.append([nome_tarefa, round(segundos, 4)])
+        mais_lentos.sort(key=lambda item: item[1], reverse=True)
+        del mais_lentos[10:]
+
+def executar_em_paralelo(funcao, tarefas, max_workers=None, timeout_tarefa=None, progresso=None):
+    """Executa funcao(*tarefa) para cada tarefa e devolve os resultados na ordem das tarefas.
+
+    Usa um pool de threads limitado por CONFIG["MAX_WORKERS_ANALISE"] (1 = sequencial).
+    Tarefas que falham ou excedem o timeout resultam em None. O timeout de cada tarefa conta a
+    partir do início da sua execução; tarefas ainda na fila só são abandonadas se nenhuma tarefa
+    iniciar ou terminar durante `timeout_tarefa` segundos. Python não interrompe threads: a
+    thread de uma tarefa abandonada continua rodando, ocupando seu lugar no pool e em
+    _SEMAFORO_TAREFAS até terminar. Se `progresso` for informado, seus contadores "concluidos",
+    "pulados" (resultado None) e "falhas" são atualizados, assim como a lista "mais_lentos".
+    """
+    max_workers = CONFIG["MAX_WORKERS_ANALISE"] if max_workers is None else max_workers
+    timeout_tarefa = CONFIG["TIMEOUT_TICKER_SEGUNDOS"] if timeout_tarefa is None else timeout_tarefa
+
+    if max_workers <= 1:
+        resultados = []
+        for tarefa in tarefas:
+            try:
+                resultado, segundos = _executar_medido(funcao, tarefa)
+                resultados.append(resultado)
+                _contabilizar(progresso, "concluidos" if resultado is not None else "pulados", tarefa[0], segundos)
+            except Exception as e:
+                logging.warning(f"Falha ao processar tarefa {tarefa[0]}: {e}")
+                _contabilizar(progresso, "falhas")
+                resultados.append(None)
+        return resultados
+
+    executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="valuation")
+    inicios = [None] * len(tarefas)
+    try:
+        futuros = {
+            executor.submit(_executar_com_limite_global, funcao, tarefa, inicios, indice): indice
+            for indice, tarefa in enumerate(tarefas)
+        }
+        resultados = [None] * len(tarefas)
+        pendentes = set(futuros)
+        iniciadas, ultimo_avanco = 0, time.monotonic()
+        while pendentes:
+            agora = time.monotonic()
+            prazos = [inicios[futuros[f]] + timeout_tarefa - agora for f in pendentes if inicios[futuros[f]] is not None]
+            concluidos, _ = wait(pendentes, timeout=max(0.0, min(prazos + [0.5])), return_when=FIRST_COMPLETED)
+            agora = time.monotonic()
+            for futuro in concluidos:
+                pendentes.discard(futuro)
+                ultimo_avanco = agora
+                tarefa = tarefas[futuros[futuro]]
+                try:
+                    resultado, segundos = futuro.result()
+                    resultados[futuros[futuro]] = resultado
+                    _contabilizar(progresso, "concluidos" if resultado is not None else "pulados", tarefa[0], segundos)
+                except Exception as e:
+                    logging.warning(f"Falha ao processar tarefa {tarefa[0]}: {e}")
+                    _contabilizar(progresso, "falhas")
+
+            total_iniciadas = sum(inicio is not None for inicio in inicios)
+            if total_iniciadas != iniciadas:
+                iniciadas, ultimo_avanco = total_iniciadas, agora
+            pool_parado = agora - ultimo_avanco > timeout_tarefa
+            for futuro in list(pendentes):
+                inicio = inicios[futuros[futuro]]
+                if (inicio is not None and agora - inicio > timeout_tarefa) or (inicio is None and pool_parado):
+                    pendentes.discard(futuro)
+                    futuro.cancel()
+                    tarefa = tarefas[futuros[futuro]]
+                    situacao = "em execução" if inicio is not None else "na fila"
+                    logging.warning(f"Tempo limite de {timeout_tarefa}s excedido para {tarefa[0]} ({situacao}).")
+                    METRICAS.incrementar("tarefas_timeout_total", funcao=funcao.__name__)
+                    _contabilizar(progresso, "falhas")
+        return resultados
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+@app.route("/metrics")
+def metrics():
+    """Métricas do processo no formato de exposição do Prometheus."""
+    return app.response_class(METRICAS.exportar_prometheus(), mimetype="text/plain; version=0.0.4")
 
 @app.route("/")
 def index():
@@ -278,46 +1102,698 @@ def market_info():
     except Exception as e:
         return jsonify({"error": f"Não foi possível carregar as premissas de mercado: {e}"}), 500
 
-@app.route("/run_analysis")
-def run_analysis():
-    """Rota principal que dispara a análise de todas as empresas."""
+EMPRESAS_EXCLUIDAS = ['ITUB4', 'BBDC4', 'BBAS3', 'SANB11', 'B3SA3']
+
+def listar_empresas_analisadas(ticker_map):
+    """Retorna ([(ticker_sa, CD_CVM)], quantidade_excluida) dos tickers únicos do mapa, sem EMPRESAS_EXCLUIDAS."""
+    tickers_unicos = ticker_map.drop_duplicates(subset=['TICKER'])
+    empresas = [
+        (f"{row.TICKER.upper()}.SA", row.CD_CVM)
+        for row in tickers_unicos.itertuples(index=False)
+        if row.TICKER not in EMPRESAS_EXCLUIDAS
+    ]
+    return empresas, len(tickers_unicos) - len(empresas)
+
+@contextmanager
+def medir_etapa(progresso, etapa):
+    """Marca a etapa atual no progresso e registra sua duração (métrica e resumo da execução)."""
+    progresso["etapa"] = etapa
+    with METRICAS.cronometrar("etapa_segundos", etapa=etapa) as medicao:
+        yield
+    progresso.setdefault("tempos_etapas", {})[etapa] = round(medicao["segundos"], 4)
+
+def executar_analise(progresso=None, detalhes=None):
+    """
+    Executa a análise de todas as empresas.
+
+    Retorna (resultados_filtrados, None) ou (None, mensagem_de_erro). Se `progresso` for
+    informado, atualiza "etapa", "total", os contadores por ticker, os tempos por etapa e,
+    ao final, "resumo" com as métricas (chamadas de rede, cache, fallbacks, descartes) da execução.
+    Se `detalhes` for informado, recebe "entradas" (fundamentos e dados de mercado das empresas
+    do resultado, no formato de montar_entradas_valuation) e "premissas" usadas.
+    """
+    progresso = progresso if progresso is not None else {"concluidos": 0, "pulados": 0, "falhas": 0}
+    metricas_inicio = METRICAS.instantaneo()
     logging.info(">>>>>> ANÁLISE INICIADA <<<<<<")
-    carregar_mapeamento_ticker_cvm.cache_clear()
-    carregar_dados_preparados.cache_clear()
-    
-    demonstrativos, error_msg = carregar_dados_preparados()
-    if error_msg: return jsonify({"error": f"Erro ao carregar dados preparados: {error_msg}"}), 500
-        
-    ticker_map, error_msg = carregar_mapeamento_ticker_cvm()
-    if error_msg: return jsonify({"error": f"Falha ao carregar mapeamento de tickers: {error_msg}"}), 500
-        
-    market_data = obter_dados_mercado()
-    
-    resultados_brutos = []
-    empresas_excluidas = ['ITUB4', 'BBDC4', 'BBAS3', 'SANB11', 'B3SA3']
-    
-    for _, row in ticker_map.drop_duplicates(subset=['TICKER']).iterrows():
-        ticker = row['TICKER']
-        if ticker in empresas_excluidas: continue
+    with medir_etapa(progresso, "carregar_dados"):
+        entradas_carregadas, error_msg = carregar_entradas_atualizadas()
+        if error_msg: return None, error_msg
+        demonstrativos, ticker_map = entradas_carregadas
         
-        resultado = processar_valuation_empresa(f"{ticker.upper()}.SA", row['CD_CVM'], demonstrativos, market_data)
-        if resultado: resultados_brutos.append(resultado)
+    with medir_etapa(progresso, "dados_mercado"):
+        market_data = obter_dados_mercado()
     
-    resultados_filtrados = []
-    for r in resultados_brutos:
-        if r is None: continue
-        wacc_ok = 0.01 < r.get('WACC', 1) < 0.40
-        upside_ok = -0.99 < r.get('Upside', 0) < 10.0
-        if wacc_ok and upside_ok:
-            resultados_filtrados.append(r)
+    empresas, n_excluidas = listar_empresas_analisadas(ticker_map)
+    descartar_empresa("excluida", n_excluidas)
+    progresso["total"] = len(empresas)
+    with medir_etapa(progresso, "betas"):
+        betas = calcular_betas_em_lote([ticker_sa for ticker_sa, _ in empresas], market_data["ibov_data"])
+    with medir_etapa(progresso, "empresas"):
+        if CONFIG["MODO_VALUATION"] == "vetorizado":
+            entradas = montar_entradas_valuation(empresas, demonstrativos["fundamentos"], betas, progresso)
+            resultados_brutos = calcular_valuation_vetorizado(entradas, market_data, registrar_metricas=True).to_dict("records")
         else:
-            logging.warning(f"Filtrando empresa {r['Ticker']} por resultados extremos: WACC={r.get('WACC', 'N/A'):.2%}, Upside={r.get('Upside', 'N/A'):.2%}")
+            tarefas = [(ticker_sa, codigo_cvm, demonstrativos, market_data, betas) for ticker_sa, codigo_cvm in empresas]
+            resultados_brutos = [r for r in executar_em_paralelo(processar_valuation_empresa, tarefas, progresso=progresso) if r]
+    
+    resultados_filtrados = filtrar_resultados_extremos(resultados_brutos)
+    if detalhes is not None:
+        tickers_resultado = {r["Ticker"] for r in resultados_filtrados}
+        if CONFIG["MODO_VALUATION"] != "vetorizado":
+            empresas_resultado = [(t, c) for t, c in empresas if t.replace('.SA', '') in tickers_resultado]
+            entradas = montar_dados_mercado_empresas(empresas_resultado, betas).join(demonstrativos["fundamentos"], on="CD_CVM")
+        detalhes["entradas"] = entradas[entradas["Ticker"].isin(tickers_resultado)].reset_index(drop=True)
+        detalhes["premissas"] = {chave: market_data[chave] for chave in DIMENSOES_SENSIBILIDADE[:3]}
 
     total_calculado = len(resultados_brutos)
     total_filtrado = len(resultados_filtrados)
+    progresso["resumo"] = METRICAS.diferenca(metricas_inicio)
     logging.info(f">>>>>> ANÁLISE CONCLUÍDA: {total_filtrado} de {total_calculado} empresas passaram no filtro. <<<<<<")
-    
-    return jsonify(resultados_filtrados)
+    logging.info(f"Tempos por etapa: {progresso['tempos_etapas']} | Resumo: {progresso['resumo']['contadores']}")
+    return resultados_filtrados, None
+
+# --- Snapshot Materializado dos Resultados ---
+# Versão 2: o snapshot passou a guardar as entradas e premissas do valuation (para /sensibilidade)
+VERSAO_SNAPSHOT = 2
+_HASHES_ARQUIVOS = {}
+_SNAPSHOT_EM_MEMORIA = {"identificador": None, "snapshot": None}
+
+def listar_arquivos_entradas():
+    """
+    Arquivos que identificam as entradas da análise: o mapa de tickers e os CSVs consolidados.
+    As cópias .arrow e .meta.json são derivadas dos CSVs, e os .tmp do update_data.py são transitórios.
+    """
+    return [CONFIG["CAMINHO_MAPA_TICKER_CVM"]] + sorted(CONFIG["DIRETORIO_DADOS_CONSOLIDADOS"].glob("*_consolidado.csv"))
+
+def _hash_arquivo(caminho):
+    """SHA-256 do conteúdo do arquivo, memorizado por (caminho, tamanho, mtime)."""
+    stat = caminho.stat()
+    identificador = (str(caminho), stat.st_size, stat.st_mtime_ns)
+    if identificador not in _HASHES_ARQUIVOS:
+        sha = hashlib.sha256()
+        with open(caminho, "rb") as arquivo:
+            for bloco in iter(lambda: arquivo.read(1 << 20), b""):
+                sha.update(bloco)
+        _HASHES_ARQUIVOS[identificador] = sha.hexdigest()
+    return _HASHES_ARQUIVOS[identificador]
+
+def calcular_hashes_entradas():
+    """Hashes de conteúdo das entradas da análise (demonstrativos e mapa de tickers) e o modo de cálculo."""
+    hashes = {}
+    for caminho in listar_arquivos_entradas():
+        try:
+            hashes[caminho.name] = _hash_arquivo(caminho)
+        except FileNotFoundError:
+            # Arquivo removido ou trocado pelo update_data.py durante a consulta
+            continue
+    hashes["MODO_VALUATION"] = CONFIG["MODO_VALUATION"]
+    return hashes
+
+def _caminho_snapshot_atual():
+    return CONFIG["DIRETORIO_SNAPSHOTS"] / "snapshot_atual.json"
+
+def _ler_snapshot(caminho):
+    """Lê o snapshot do disco, reaproveitando a cópia em memória enquanto o arquivo não mudar."""
+    stat = caminho.stat()
+    identificador = (str(caminho), stat.st_size, stat.st_mtime_ns)
+    if _SNAPSHOT_EM_MEMORIA["identificador"] != identificador:
+        snapshot = json.loads(caminho.read_text(encoding="utf-8"))
+        _SNAPSHOT_EM_MEMORIA.update(identificador=identificador, snapshot=snapshot)
+    return _SNAPSHOT_EM_MEMORIA["snapshot"]
+
+def carregar_snapshot_valido():
+    """
+    Retorna o snapshot atual se ele ainda corresponder às entradas em disco e se os dados de
+    mercado usados não forem mais antigos que CONFIG["VALIDADE_SNAPSHOT_SEGUNDOS"]. Senão, None.
+    """
+    caminho = _caminho_snapshot_atual()
+    if not caminho.exists():
+        return None
+    try:
+        snapshot = _ler_snapshot(caminho)
+    except Exception as e:
+        logging.warning(f"Snapshot de resultados ilegível, será recalculado. Erro: {e}")
+        return None
+    if snapshot.get("versao") != VERSAO_SNAPSHOT:
+        return None
+    if time.time() - snapshot["dados_mercado_em"] > CONFIG["VALIDADE_SNAPSHOT_SEGUNDOS"]:
+        return None
+    if snapshot["hashes_entradas"] != calcular_hashes_entradas():
+        return None
+    return snapshot
+
+def salvar_snapshot(resultados, hashes_entradas, dados_mercado_em, resumo_execucao=None, entradas=None, premissas=None):
+    """
+    Grava o snapshot versionado (snapshot_<chave>.json) e o publica atomicamente como
+    snapshot_atual.json, compartilhado por todos os workers. Mantém as últimas versões.
+    """
+    chave = hashlib.sha256(
+        json.dumps({"hashes": hashes_entradas, "mercado": dados_mercado_em}, sort_keys=True).encode()
+    ).hexdigest()[:16]
+    snapshot = {
+        "versao": VERSAO_SNAPSHOT, "chave": chave, "hashes_entradas": hashes_entradas,
+        "dados_mercado_em": dados_mercado_em, "gerado_em": time.time(),
+        "resumo_execucao": resumo_execucao, "premissas": premissas,
+        "entradas_valuation": None if entradas is None else json.loads(entradas.to_json(orient="records", double_precision=15)),
+        "resultados": resultados,
+    }
+    diretorio = CONFIG["DIRETORIO_SNAPSHOTS"]
+    diretorio.mkdir(parents=True, exist_ok=True)
+    caminho_versao = diretorio / f"snapshot_{chave}.json"
+    caminho_temp = diretorio / f".snapshot_{chave}.{os.getpid()}.tmp"
+    caminho_temp.write_text(json.dumps(snapshot, ensure_ascii=False), encoding="utf-8")
+    os.replace(caminho_temp, caminho_versao)
+    caminho_temp_atual = diretorio / f".snapshot_atual.{os.getpid()}.tmp"
+    caminho_temp_atual.write_bytes(caminho_versao.read_bytes())
+    os.replace(caminho_temp_atual, _caminho_snapshot_atual())
+
+    versoes = sorted(diretorio.glob("snapshot_*.json"), key=lambda c: c.stat().st_mtime, reverse=True)
+    for antigo in [c for c in versoes if c.name != "snapshot_atual.json"][CONFIG["MAX_SNAPSHOTS_ARMAZENADOS"]:]:
+        antigo.unlink(missing_ok=True)
+    logging.info(f"Snapshot de resultados {chave} publicado com {len(resultados)} empresas.")
+    return snapshot
+
+def gerar_snapshot_resultados(progresso=None):
+    """Executa a análise completa e publica o snapshot. Retorna (snapshot, None) ou (None, erro)."""
+    progresso = progresso if progresso is not None else {"concluidos": 0, "pulados": 0, "falhas": 0}
+    hashes_entradas = calcular_hashes_entradas()
+    detalhes = {}
+    inicio = time.time()
+    with coletar_instante_dados_mercado() as coleta:
+        resultados, erro = executar_analise(progresso, detalhes)
+    if erro:
+        return None, erro
+    # Idade real dos dados de mercado: cotações e séries podem ter vindo de entradas antigas do cache
+    dados_mercado_em = min(inicio, coleta["instante"] or inicio)
+    try:
+        return salvar_snapshot(resultados, hashes_entradas, dados_mercado_em, progresso.get("resumo"),
+                               detalhes.get("entradas"), detalhes.get("premissas")), None
+    except Exception as e:
+        logging.error(f"Falha ao gravar o snapshot de resultados: {e}", exc_info=True)
+        snapshot = {"versao": VERSAO_SNAPSHOT, "hashes_entradas": hashes_entradas,
+                    "dados_mercado_em": dados_mercado_em, "resultados": resultados}
+        return snapshot, None
+
+# --- Jobs de Análise em Segundo Plano ---
+# O estado dos jobs fica num SQLite compartilhado: qualquer worker responde ao acompanhamento e,
+# para as mesmas entradas, só um worker executa o cálculo.
+_REGISTROS_JOBS = {}
+_LOCK_JOBS = threading.Lock()
+
+def calcular_chave_entradas():
+    """Identifica o conjunto de entradas da análise: arquivos de dados, mapa de tickers, modo e dia."""
+    partes = [CONFIG["MODO_VALUATION"], datetime.now().strftime("%Y-%m-%d")]
+    for caminho in listar_arquivos_entradas():
+        try:
+            stat = caminho.stat()
+        except FileNotFoundError:
+            continue
+        partes.append(f"{caminho.name}:{stat.st_size}:{stat.st_mtime_ns}")
+    return hashlib.sha256("|".join(partes).encode()).hexdigest()[:16]
+
+# Chave (calcular_chave_entradas) dos demonstrativos e do mapa de tickers mantidos em memória
+_ENTRADAS_EM_MEMORIA = {"chave": None}
+_LOCK_ENTRADAS = threading.Lock()
+
+def carregar_entradas_atualizadas():
+    """
+    Retorna ((demonstrativos, ticker_map), None) ou (None, erro). Os dados em memória (inclusive os
+    carregados pelo aquecimento antes do fork) só são descartados quando calcular_chave_entradas muda.
+    """
+    chave = calcular_chave_entradas()
+    with _LOCK_ENTRADAS:
+        if _ENTRADAS_EM_MEMORIA["chave"] != chave:
+            carregar_mapeamento_ticker_cvm.cache_clear()
+            carregar_dados_preparados.cache_clear()
+            _ENTRADAS_EM_MEMORIA["chave"] = chave
+        demonstrativos, error_msg = carregar_dados_preparados()
+        if not error_msg:
+            ticker_map, erro_mapa = carregar_mapeamento_ticker_cvm()
+            error_msg = erro_mapa and f"Falha ao carregar mapeamento de tickers: {erro_mapa}"
+        else:
+            error_msg = f"Erro ao carregar dados preparados: {error_msg}"
+        if error_msg:
+            # Falhas também ficam no lru_cache: força nova tentativa na próxima chamada
+            _ENTRADAS_EM_MEMORIA["chave"] = None
+            return None, error_msg
+    return (demonstrativos, ticker_map), None
+
+def registro_jobs():
+    """Registro de jobs (SQLite ao lado dos snapshots), compartilhado por todos os workers."""
+    caminho = CONFIG["DIRETORIO_SNAPSHOTS"] / "jobs.sqlite3"
+    with _LOCK_JOBS:
+        if caminho not in _REGISTROS_JOBS:
+            _REGISTROS_JOBS[caminho] = RegistroJobs(caminho, CONFIG["MAX_JOBS_ARMAZENADOS"])
+        return _REGISTROS_JOBS[caminho]
+
+def _publicar_progresso(job_id, progresso, parar):
+    """Grava o progresso (e o heartbeat) do job até `parar` ser sinalizado."""
+    while not parar.wait(CONFIG["INTERVALO_PROGRESSO_JOB_SEGUNDOS"]):
+        try:
+            registro_jobs().atualizar(job_id, progresso=dict(progresso))
+        except (RuntimeError, ValueError, TypeError) as e:
+            # O progresso pode mudar durante a serialização; a próxima publicação resolve
+            logging.debug(f"Progresso do job {job_id} não publicado: {e}")
+
+def _executar_job(job_id, executar):
+    """Roda executar(progresso) -> (resultado, erro) e grava o desfecho no registro compartilhado."""
+    registro = registro_jobs()
+    progresso = {"etapa": "iniciando", "total": None, "concluidos": 0, "pulados": 0, "falhas": 0}
+    registro.atualizar(job_id, status="executando", iniciado_em=time.time(), progresso=progresso)
+    parar = threading.Event()
+    threading.Thread(target=_publicar_progresso, args=(job_id, progresso, parar),
+                     name=f"progresso-{job_id[:8]}", daemon=True).start()
+    try:
+        resultado, erro = executar(progresso)
+    except Exception as e:
+        logging.error(f"Erro inesperado no job {job_id}: {e}", exc_info=True)
+        resultado, erro = None, f"Erro inesperado no job: {e}"
+    finally:
+        parar.set()
+    status = "erro" if erro else "concluido"
+    progresso["etapa"] = status
+    registro.atualizar(job_id, status=status, progresso=dict(progresso), resultado=resultado, erro=erro,
+                       concluido_em=time.time())
+
+def iniciar_job(tipo, executar, validade, resultado_pronto=None):
+    """
+    Inicia um job do `tipo` para as entradas atuais ou reaproveita um existente (de qualquer worker).
+
+    Um job em andamento com a mesma chave é sempre reaproveitado; um job concluído é
+    reaproveitado enquanto estiver dentro de `validade` segundos. Se `resultado_pronto` for
+    informado (ex.: resultados de um snapshot válido), o job já nasce concluído com ele.
+    Retorna (job, criado).
+    """
+    chave = calcular_chave_entradas()
+    agora = time.time()
+    novo_job = {
+        "id": uuid.uuid4().hex, "status": "pendente", "iniciado_em": None, "concluido_em": None,
+        "progresso": {"etapa": "na fila", "total": None, "concluidos": 0, "pulados": 0, "falhas": 0},
+        "erro": None,
+    }
+    if resultado_pronto is not None:
+        novo_job.update(status="concluido", iniciado_em=agora, concluido_em=agora, resultado=resultado_pronto)
+        novo_job["progresso"].update(etapa="snapshot", total=len(resultado_pronto), concluidos=len(resultado_pronto))
+    job, criado = registro_jobs().reivindicar(tipo, chave, validade, CONFIG["PRAZO_ABANDONO_JOB_SEGUNDOS"], novo_job)
+    if criado and resultado_pronto is None:
+        threading.Thread(target=_executar_job, args=(job["id"], executar),
+                         name=f"{tipo}-{job['id'][:8]}", daemon=True).start()
+    return job, criado and resultado_pronto is None
+
+def _executar_analise_do_job(progresso):
+    snapshot, erro = gerar_snapshot_resultados(progresso)
+    return (snapshot["resultados"] if snapshot else None), erro
+
+def iniciar_job_analise():
+    """Job de análise completa; se houver snapshot válido em disco, já nasce concluído com ele."""
+    snapshot = carregar_snapshot_valido()
+    return iniciar_job("analise", _executar_analise_do_job, CONFIG["VALIDADE_JOB_SEGUNDOS"],
+                       resultado_pronto=None if snapshot is None else snapshot["resultados"])
+
+def aguardar_job(job_id):
+    """Espera (consultando o registro) até o job terminar; um job abandonado vira erro."""
+    while True:
+        job = registro_jobs().obter(job_id)
+        if job is None or job["status"] in ("concluido", "erro"):
+            return job
+        if time.time() - job["atualizado_em"] > CONFIG["PRAZO_ABANDONO_JOB_SEGUNDOS"]:
+            erro = "Job interrompido: o processo que o executava parou de responder."
+            registro_jobs().atualizar(job_id, status="erro", erro=erro, concluido_em=time.time())
+            return dict(job, status="erro", erro=erro)
+        time.sleep(0.5)
+
+def resumir_job(job):
+    """Representação pública (JSON) do estado de um job."""
+    return {
+        "job_id": job["id"], "tipo": job["tipo"], "status": job["status"], "progresso": dict(job["progresso"]),
+        "criado_em": job["criado_em"], "iniciado_em": job["iniciado_em"], "concluido_em": job["concluido_em"],
+        "erro": job["erro"],
+        "url_progresso": url_for("progresso_analise", job_id=job["id"]),
+        "url_resultado": url_for("resultado_analise", job_id=job["id"]),
+    }
+
+@app.route("/analises", methods=["POST"])
+def iniciar_analise():
+    """Inicia (ou reaproveita) uma análise em segundo plano e retorna o id do job."""
+    job, criado = iniciar_job_analise()
+    return jsonify(resumir_job(job)), 202 if criado or job["status"] != "concluido" else 200
+
+@app.route("/analises/<job_id>")
+def progresso_analise(job_id):
+    """Progresso do job: etapa e tickers concluídos, pulados e com falha."""
+    job = registro_jobs().obter(job_id)
+    if job is None: return jsonify({"error": "Job de análise não encontrado."}), 404
+    return jsonify(resumir_job(job))
+
+@app.route("/analises/<job_id>/resultado")
+def resultado_analise(job_id):
+    """Resultados do job concluído (202 enquanto ainda estiver em andamento)."""
+    job = registro_jobs().obter(job_id, com_resultado=True)
+    if job is None:
+        # Job já descartado do registro: os resultados da análise continuam no snapshot compartilhado
+        snapshot = carregar_snapshot_valido()
+        if snapshot is not None: return jsonify(snapshot["resultados"])
+        return jsonify({"error": "Job de análise não encontrado."}), 404
+    if job["status"] == "erro": return jsonify({"error": job["erro"]}), 500
+    if job["status"] != "concluido": return jsonify(resumir_job(job)), 202
+    return jsonify(job["resultado"])
+
+# --- Consulta de Resultados no Servidor ---
+CAMPOS_NUMERICOS = [
+    'Upside', 'ROIC', 'WACC', 'Spread', 'EVA_percent', 'EFV_percent', 'Preco_Atual',
+    'Preco_Justo', 'Market_Cap', 'EVA', 'Capital_Empregado', 'NOPAT',
+]
+CAMPOS_RESULTADO = ['Nome', 'Ticker'] + CAMPOS_NUMERICOS
+
+def ler_consulta_resultados(parametros):
+    """
+    Valida os parâmetros da query string e devolve a consulta a aplicar com consultar_resultados.
+
+    Parâmetros aceitos: ordenar (campo numérico, padrão Upside), ordem (asc|desc), busca
+    (trecho do ticker ou nome), min_<campo>/max_<campo>, pagina (a partir de 1),
+    tamanho_pagina e campos (lista separada por vírgulas). Lança ValueError se inválidos.
+    """
+    ordenar = parametros.get("ordenar", "Upside")
+    if ordenar not in CAMPOS_NUMERICOS:
+        raise ValueError(f"Campo de ordenação inválido: '{ordenar}'. Use um de {CAMPOS_NUMERICOS}.")
+    ordem = parametros.get("ordem", "desc").lower()
+    if ordem not in ("asc", "desc"):
+        raise ValueError("Parâmetro 'ordem' deve ser 'asc' ou 'desc'.")
+    campos = parametros.get("campos")
+    campos = [c.strip() for c in campos.split(",") if c.strip()] if campos else CAMPOS_RESULTADO
+    invalidos = [c for c in campos if c not in CAMPOS_RESULTADO]
+    if invalidos:
+        raise ValueError(f"Campos inválidos: {invalidos}.")
+    try:
+        pagina = int(parametros.get("pagina", 1))
+        tamanho_pagina = int(parametros.get("tamanho_pagina", CONFIG["TAMANHO_PAGINA_PADRAO"]))
+        limites = []
+        for nome, valor in parametros.items():
+            prefixo, _, campo = nome.partition("_")
+            if prefixo in ("min", "max") and campo:
+                if campo not in CAMPOS_NUMERICOS:
+                    raise ValueError(f"Filtro em campo inválido: '{campo}'.")
+                limites.append((prefixo, campo, float(valor)))
+    except (TypeError, ValueError) as e:
+        raise ValueError(f"Parâmetro numérico inválido: {e}")
+    if pagina < 1 or not 1 <= tamanho_pagina <= CONFIG["TAMANHO_PAGINA_MAXIMO"]:
+        raise ValueError(f"Use pagina >= 1 e tamanho_pagina entre 1 e {CONFIG['TAMANHO_PAGINA_MAXIMO']}.")
+    return {
+        "ordenar": ordenar, "ordem": ordem, "campos": campos, "pagina": pagina, "tamanho_pagina": tamanho_pagina,
+        "limites": limites, "busca": parametros.get("busca", "").strip().upper(),
+    }
+
+def consultar_resultados(resultados, consulta):
+    """Filtra, ordena e pagina a lista de resultados conforme a consulta de ler_consulta_resultados."""
+    ordenar, ordem, campos, busca, limites = (consulta[k] for k in ("ordenar", "ordem", "campos", "busca", "limites"))
+    pagina, tamanho_pagina = consulta["pagina"], consulta["tamanho_pagina"]
+    selecionados = []
+    for r in resultados:
+        if busca and busca not in r["Ticker"].upper() and busca not in str(r["Nome"]).upper():
+            continue
+        if any((r[campo] < limite) if prefixo == "min" else (r[campo] > limite) for prefixo, campo, limite in limites):
+            continue
+        selecionados.append(r)
+
+    # Valores ausentes (NaN) ficam sempre no fim, em qualquer ordem
+    validos = [r for r in selecionados if not math.isnan(r[ordenar])]
+    ausentes = [r for r in selecionados if math.isnan(r[ordenar])]
+    validos.sort(key=lambda r: r[ordenar], reverse=(ordem == "desc"))
+    selecionados = validos + ausentes
+
+    inicio = (pagina - 1) * tamanho_pagina
+    return {
+        "total": len(selecionados), "pagina": pagina, "tamanho_pagina": tamanho_pagina,
+        "total_paginas": max(1, math.ceil(len(selecionados) / tamanho_pagina)),
+        "ordenar": ordenar, "ordem": ordem,
+        "resultados": [{c: r[c] for c in campos} for r in selecionados[inicio:inicio + tamanho_pagina]],
+    }
+
+def resposta_json_compacta(dados):
+    """Resposta JSON sem espaços, com ETag (304 em revalidação) e gzip quando o cliente aceita."""
+    corpo = json.dumps(dados, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    resposta = app.response_class(corpo, mimetype="application/json")
+    resposta.set_etag(hashlib.sha256(corpo).hexdigest()[:32], weak=True)
+    resposta.headers["Cache-Control"] = "no-cache"
+    resposta.vary.add("Accept-Encoding")
+    resposta = resposta.make_conditional(request)
+    if resposta.status_code == 200 and "gzip" in request.accept_encodings and len(corpo) > 1024:
+        resposta.set_data(gzip.compress(corpo, compresslevel=6))
+        resposta.headers["Content-Encoding"] = "gzip"
+    return resposta
+
+@app.route("/resultados")
+def resultados_paginados():
+    """Resultados do snapshot atual, filtrados, ordenados e paginados no servidor."""
+    # Parâmetros inválidos são recusados antes de qualquer análise ser disparada
+    try:
+        consulta = ler_consulta_resultados(request.args.to_dict())
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    snapshot = carregar_snapshot_valido()
+    if snapshot is None:
+        job, _ = iniciar_job_analise()
+        if job["status"] == "erro": return jsonify({"error": job["erro"]}), 500
+        if job["status"] != "concluido": return jsonify(resumir_job(job)), 202
+        resultados = registro_jobs().obter(job["id"], com_resultado=True)["resultado"]
+    else:
+        resultados = snapshot["resultados"]
+    return resposta_json_compacta(consultar_resultados(resultados, consulta))
+
+# --- Sensibilidade do Preço Justo às Premissas ---
+_ENTRADAS_SENSIBILIDADE = {"chave": None, "entradas": None}
+
+def _entradas_do_snapshot(snapshot):
+    """DataFrame das entradas do valuation guardadas no snapshot, montado uma vez por snapshot."""
+    if _ENTRADAS_SENSIBILIDADE["chave"] != snapshot.get("chave"):
+        entradas = pd.DataFrame(snapshot.get("entradas_valuation") or [])
+        _ENTRADAS_SENSIBILIDADE.update(chave=snapshot.get("chave"), entradas=entradas)
+    return _ENTRADAS_SENSIBILIDADE["entradas"]
+
+def _ler_valores_grade(texto, padrao, max_valores):
+    """
+    Lê "v1,v2,..." ou "inicio:fim:passos" (inclusivo); sem texto, usa o valor padrão.
+    A quantidade de valores é conferida contra `max_valores` antes de qualquer alocação.
+    """
+    if not texto:
+        return np.array([padrao], dtype=float)
+    if ":" in texto:
+        inicio, fim, passos = texto.split(":")
+        passos = int(passos)
+        if not 1 <= passos <= max_valores:
+            raise ValueError(f"Número de passos inválido em '{texto}' (entre 1 e {max_valores}).")
+        valores = np.linspace(float(inicio), float(fim), passos)
+    else:
+        if texto.count(",") + 1 > max_valores:
+            raise ValueError(f"Mais de {max_valores} valores em '{texto[:50]}...'.")
+        valores = np.array([float(valor) for valor in texto.split(",")], dtype=float)
+    if not np.isfinite(valores).all():
+        raise ValueError(f"Valores não finitos em '{texto}'.")
+    return valores
+
+def ler_grade_sensibilidade(parametros, premissas):
+    """
+    Lê a grade (rf, premio, g e ajuste_beta) da query string, usando `premissas` para as dimensões
+    omitidas. Levanta ValueError se algum valor for inválido ou a grade passar do tamanho máximo.
+    """
+    nomes_parametros = {"risk_free_rate": "rf", "premio_risco_mercado": "premio", "cresc_perpetuo": "g", "ajuste_beta": "ajuste_beta"}
+    try:
+        grade = {dimensao: _ler_valores_grade(parametros.get(nome, "").strip(), premissas.get(dimensao, 0.0),
+                                              CONFIG["MAX_PONTOS_SENSIBILIDADE"])
+                 for dimensao, nome in nomes_parametros.items()}
+    except (TypeError, ValueError) as e:
+        raise ValueError(f"Parâmetro de grade inválido: {e}")
+    pontos = math.prod(len(grade[d]) for d in DIMENSOES_SENSIBILIDADE)
+    if pontos > CONFIG["MAX_PONTOS_SENSIBILIDADE"]:
+        raise ValueError(f"A grade tem {pontos} pontos; o máximo é {CONFIG['MAX_PONTOS_SENSIBILIDADE']}.")
+    return grade
+
+def consultar_sensibilidade(snapshot, parametros):
+    """
+    Monta a resposta de /sensibilidade a partir das entradas do snapshot, sem buscar dados de mercado.
+    Parâmetros: rf, premio, g e ajuste_beta (listas ou faixas) e tickers (opcional, separados por vírgula).
+    Levanta ValueError em parâmetros inválidos.
+    """
+    grade = ler_grade_sensibilidade(parametros, snapshot.get("premissas") or {})
+    formato = [len(grade[d]) for d in DIMENSOES_SENSIBILIDADE]
+
+    entradas = _entradas_do_snapshot(snapshot)
+    tickers = {t.strip().upper().removesuffix(".SA") for t in parametros.get("tickers", "").split(",") if t.strip()}
+    if tickers and not entradas.empty:
+        entradas = entradas[entradas["Ticker"].isin(tickers)]
+    if entradas.empty:
+        preco_justo = upside = np.empty((0, math.prod(formato)))
+    else:
+        preco_justo, upside = calcular_grade_sensibilidade(entradas, grade)
+
+    def serializar(matriz):
+        return np.where(np.isfinite(matriz), matriz, None).tolist()
+
+    return {
+        "snapshot": snapshot.get("chave"), "dimensoes": DIMENSOES_SENSIBILIDADE, "formato": formato,
+        "grade": {d: grade[d].tolist() for d in DIMENSOES_SENSIBILIDADE},
+        "empresas": [
+            {"Ticker": ticker, "Nome": nome, "Preco_Atual": preco_atual, "Preco_Justo": precos, "Upside": upsides}
+            for ticker, nome, preco_atual, precos, upsides in zip(
+                entradas.get("Ticker", []), entradas.get("Nome", []), entradas.get("preco_atual", []),
+                serializar(preco_justo), serializar(upside))
+        ],
+    }
+
+@app.route("/sensibilidade")
+def sensibilidade():
+    """Preço justo e upside por empresa para cada combinação de rf, prêmio de risco, g e ajuste de beta."""
+    # Grade inválida ou grande demais é recusada antes de qualquer análise ser disparada
+    try:
+        ler_grade_sensibilidade(request.args.to_dict(), {})
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    snapshot = carregar_snapshot_valido()
+    if snapshot is None:
+        job, _ = iniciar_job_analise()
+        if job["status"] == "erro": return jsonify({"error": job["erro"]}), 500
+        if job["status"] != "concluido": return jsonify(resumir_job(job)), 202
+        snapshot = carregar_snapshot_valido()
+        if snapshot is None: return jsonify({"error": "Snapshot de resultados indisponível."}), 503
+    try:
+        consulta = consultar_sensibilidade(snapshot, request.args.to_dict())
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return resposta_json_compacta(consulta)
+
+# --- Valuation Histórico ---
+
+# Registros do último job de histórico lido do registro compartilhado: {"job_id": ..., "registros": [...]}
+_HISTORICO_CALCULADO = {"job_id": None, "registros": None}
+_LOCK_HISTORICO = threading.Lock()
+
+def _calcular_historico_para_entradas():
+    entradas_carregadas, error_msg = carregar_entradas_atualizadas()
+    if error_msg: return None, error_msg
+    demonstrativos, ticker_map = entradas_carregadas
+    market_data = obter_dados_mercado()
+
+    fundamentos_historicos = construir_fundamentos_historicos(demonstrativos)
+    com_historico = set(fundamentos_historicos["CD_CVM"])
+    empresas = [(ticker_sa, codigo_cvm) for ticker_sa, codigo_cvm in listar_empresas_analisadas(ticker_map)[0]
+                if codigo_cvm in com_historico]
+    tickers = [ticker_sa for ticker_sa, _ in empresas]
+    betas = calcular_betas_em_lote(tickers, market_data["ibov_data"])
+    mercado = montar_dados_mercado_empresas(empresas, betas)
+    fechamentos = baixar_fechamentos_em_lote(tickers, campo="Close")
+
+    historico = calcular_valuation_historico(fundamentos_historicos, mercado, fechamentos, market_data)
+    historico = historico.sort_values(["Ticker", "DT_REFER"]).astype(object)
+    historico = historico.where(historico.map(lambda v: not isinstance(v, float) or math.isfinite(v)), None)
+    logging.info(f"Valuation histórico calculado: {len(historico)} exercícios de {historico['Ticker'].nunique()} empresas.")
+    return historico.to_dict("records"), None
+
+def _executar_historico_do_job(progresso):
+    progresso["etapa"] = "historico"
+    registros, erro = _calcular_historico_para_entradas()
+    if not erro and not registros:
+        # Sem nenhum exercício com preço de referência (ex.: Yahoo indisponível): não vale como resultado
+        erro = "Nenhum exercício com preço de referência disponível; tente novamente mais tarde."
+    return registros, erro
+
+def obter_valuation_historico():
+    """
+    Trajetória anual de EVA, ROIC, WACC e preço justo de todas as empresas, calculada num job
+    compartilhado por conjunto de entradas (ver calcular_chave_entradas e iniciar_job).
+    Retorna (registros, None) quando pronto, ou (None, job) enquanto o job está em andamento. Quem
+    acompanha o job (url_progresso/url_resultado) recebe o erro dele se falhar, sem novo cálculo;
+    só uma nova requisição a /historico dispara outro job.
+    """
+    job, _ = iniciar_job("historico", _executar_historico_do_job, CONFIG["VALIDADE_HISTORICO_SEGUNDOS"])
+    if job["status"] != "concluido":
+        return None, job
+    with _LOCK_HISTORICO:
+        if _HISTORICO_CALCULADO["job_id"] != job["id"]:
+            registros = registro_jobs().obter(job["id"], com_resultado=True)["resultado"]
+            _HISTORICO_CALCULADO.update(job_id=job["id"], registros=registros)
+        return _HISTORICO_CALCULADO["registros"], None
+
+@app.route("/historico")
+def historico_todas_empresas():
+    """Valuation de todos os exercícios de todas as empresas (202 com o job enquanto é calculado)."""
+    registros, job = obter_valuation_historico()
+    if job is not None: return jsonify(resumir_job(job)), 202
+    return resposta_json_compacta(registros)
+
+@app.route("/historico/<ticker>")
+def historico_empresa(ticker):
+    """Valuation de todos os exercícios de um ticker, ex.: PETR4 ou PETR4.SA (202 enquanto é calculado)."""
+    registros, job = obter_valuation_historico()
+    if job is not None: return jsonify(resumir_job(job)), 202
+    ticker = ticker.upper().removesuffix(".SA")
+    selecionados = [r for r in registros if r["Ticker"] == ticker]
+    if not selecionados: return jsonify({"error": f"Sem histórico de valuation para '{ticker}'."}), 404
+    return resposta_json_compacta(selecionados)
+
+@app.route("/run_analysis")
+def run_analysis():
+    """Rota síncrona: serve o snapshot válido ou dispara (e aguarda) a análise de todas as empresas."""
+    snapshot = carregar_snapshot_valido()
+    if snapshot is not None: return jsonify(snapshot["resultados"])
+    job, _ = iniciar_job_analise()
+    job = aguardar_job(job["id"])
+    if job is None: return jsonify({"error": "Job de análise não encontrado."}), 404
+    if job["erro"]: return jsonify({"error": job["erro"]}), 500
+    return jsonify(registro_jobs().obter(job["id"], com_resultado=True)["resultado"])
+
+# --- Aquecimento e Prontidão ---
+_ESTADO_AQUECIMENTO = {"status": "desativado", "iniciado_em": None, "concluido_em": None, "erro": None, "tempos_etapas": {}}
+
+def aquecer_aplicacao():
+    """
+    Carrega uma vez os módulos pesados, os demonstrativos, o mapa de tickers e os dados de
+    mercado, para que a primeira requisição não pague por isso. Demonstrativos e mapa ficam em
+    memória (e são herdados pelos workers quando o aquecimento roda antes do fork); os dados de
+    mercado ficam no cache em disco, compartilhado pelos workers e sujeito aos TTLs.
+    """
+    estado = _ESTADO_AQUECIMENTO
+    estado.update(status="aquecendo", iniciado_em=time.time(), concluido_em=None, erro=None, tempos_etapas={})
+    try:
+        etapas = [
+            ("modulos", lambda: [m.carregar() for m in (yf, stats) if isinstance(m, _ModuloSobDemanda)]),
+            ("sessao_http", lambda: CLIENTE_HTTP.sessao),
+            ("demonstrativos_e_mapa", carregar_entradas_atualizadas),
+            ("dados_mercado", obter_dados_mercado),
+        ]
+        for etapa, funcao in etapas:
+            with METRICAS.cronometrar("aquecimento_segundos", etapa=etapa) as medicao:
+                resultado = funcao()
+            estado["tempos_etapas"][etapa] = round(medicao["segundos"], 4)
+            if isinstance(resultado, tuple) and len(resultado) == 2 and resultado[1]:
+                raise RuntimeError(resultado[1])
+        estado["status"] = "pronto"
+        logging.info(f"Aquecimento concluído em {time.time() - estado['iniciado_em']:.2f}s: {estado['tempos_etapas']}")
+    except Exception as e:
+        logging.error(f"Falha no aquecimento da aplicação: {e}", exc_info=True)
+        estado.update(status="erro", erro=str(e))
+    estado["concluido_em"] = time.time()
+
+def iniciar_aquecimento(modo=None):
+    """Dispara o aquecimento conforme CONFIG["AQUECIMENTO_INICIAL"] (ou `modo`)."""
+    modo = CONFIG["AQUECIMENTO_INICIAL"] if modo is None else modo
+    if modo in ("", "0", "nao", "desligado"):
+        return
+    if modo == "segundo_plano":
+        _ESTADO_AQUECIMENTO["status"] = "aquecendo"
+        threading.Thread(target=aquecer_aplicacao, name="aquecimento", daemon=True).start()
+    elif modo in ("1", "sincrono"):
+        aquecer_aplicacao()
+    else:
+        logging.warning(f"Modo de aquecimento desconhecido: '{modo}'. Use 'sincrono' ou 'segundo_plano'.")
+
+@app.route("/ready")
+def ready():
+    """Prontidão: 200 quando o aquecimento terminou (ou está desligado), 503 enquanto aquece ou se falhou."""
+    estado = {chave: valor for chave, valor in _ESTADO_AQUECIMENTO.items()}
+    pronto = estado["status"] in ("pronto", "desativado")
+    return jsonify(dict(estado, pronto=pronto)), 200 if pronto else 503
+
+iniciar_aquecimento()
 
 if __name__ == "__main__":
     app.run(debug=True, host="0.0.0.0", port=5000)
\ No newline at end of file
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+"""
+Registro de métricas em memória (contadores e histogramas de duração) para o pipeline de valuation.
+
+As métricas são exportadas no formato texto do Prometheus pelo endpoint /metrics e também
+podem ser comparadas entre dois instantes para montar o resumo de uma execução. Cada processo
+(worker do gunicorn) mantém o seu próprio registro.
+"""
+import threading
+import time
+from contextlib import contextmanager
+
+# Limites (em segundos) dos buckets dos histogramas de duração
+BUCKETS_DURACAO = (0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+def _chave(nome, labels):
+    return nome, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _formatar_labels(labels, extra=()):
+    pares = list(labels) + list(extra)
+    if not pares:
+        return ""
+    return "{" + ",".join(f'{k}="{str(v).replace(chr(34), chr(39))}"' for k, v in pares) + "}"
+
+
+class RegistroMetricas:
+    def __init__(self, prefixo="valuation"):
+        self.prefixo = prefixo
+        self._lock = threading.Lock()
+        self._contadores = {}
+        self._histogramas = {}
+
+    def incrementar(self, nome, valor=1, **labels):
+        chave = _chave(nome, labels)
+        with self._lock:
+            self._contadores[chave] = self._contadores.get(chave, 0) + valor
+
+    def registrar_duracao(self, nome, segundos, **labels):
+        chave = _chave(nome, labels)
+        with self._lock:
+            histograma = self._histogramas.get(chave)
+            if histograma is None:
+                histograma = self._histogramas[chave] = {"contagem": 0, "soma": 0.0, "buckets": [0] * len(BUCKETS_DURACAO)}
+            histograma["contagem"] += 1
+            histograma["soma"] += segundos
+            for i, limite in enumerate(BUCKETS_DURACAO):
+                if segundos <= limite:
+                    histograma["buckets"][i] += 1
+
+    @contextmanager
+    def cronometrar(self, nome, **labels):
+        """Mede o bloco e registra a duração; o dicionário devolvido recebe a chave "segundos"."""
+        medicao = {}
+        inicio = time.perf_counter()
+        try:
+            yield medicao
+        finally:
+            medicao["segundos"] = time.perf_counter() - inicio
+            self.registrar_duracao(nome, medicao["segundos"], **labels)
+
+    def instantaneo(self):
+        """Cópia dos contadores e das somas/contagens dos histogramas, para calcular diferenças."""
+        with self._lock:
+            return {
+                "contadores": dict(self._contadores),
+                "histogramas": {k: (h["contagem"], h["soma"]) for k, h in self._histogramas.items()},
+            }
+
+    def diferenca(self, anterior):
+        """Resumo legível do que mudou desde `anterior` (um retorno de instantaneo())."""
+        atual = self.instantaneo()
+        resumo = {"contadores": {}, "duracoes": {}}
+        for (nome, labels), valor in atual["contadores"].items():
+            delta = valor - anterior["contadores"].get((nome, labels), 0)
+            if delta:
+                resumo["contadores"][nome + _formatar_labels(labels)] = delta
+        for (nome, labels), (contagem, soma) in atual["histogramas"].items():
+            contagem_anterior, soma_anterior = anterior["histogramas"].get((nome, labels), (0, 0.0))
+            if contagem - contagem_anterior:
+                resumo["duracoes"][nome + _formatar_labels(labels)] = {
+                    "contagem": contagem - contagem_anterior,
+                    "soma_segundos": round(soma - soma_anterior, 4),
+                }
+        return resumo
+
+    def exportar_prometheus(self):
+        """Texto no formato de exposição do Prometheus (versão 0.0.4)."""
+        with self._lock:
+            contadores = sorted(self._contadores.items(), key=lambda item: item[0])
+            histogramas = sorted(
+                ((k, dict(h, buckets=list(h["buckets"]))) for k, h in self._histogramas.items()),
+                key=lambda item: item[0],
+            )
+        linhas = []
+        declarados = set()
+        for (nome, labels), valor in contadores:
+            nome_completo = f"{self.prefixo}_{nome}"
+            if nome_completo not in declarados:
+                linhas.append(f"# TYPE {nome_completo} counter")
+                declarados.add(nome_completo)
+            linhas.append(f"{nome_completo}{_formatar_labels(labels)} {valor}")
+        for (nome, labels), histograma in histogramas:
+            nome_completo = f"{self.prefixo}_{nome}"
+            if nome_completo not in declarados:
+                linhas.append(f"# TYPE {nome_completo} histogram")
+                declarados.add(nome_completo)
+            for limite, quantidade in zip(BUCKETS_DURACAO, histograma["buckets"]):
+                linhas.append(f"{nome_completo}_bucket{_formatar_labels(labels, [('le', limite)])} {quantidade}")
+            linhas.append(f"{nome_completo}_bucket{_formatar_labels(labels, [('le', '+Inf')])} {histograma['contagem']}")
+            linhas.append(f"{nome_completo}_sum{_formatar_labels(labels)} {histograma['soma']}")
+            linhas.append(f"{nome_completo}_count{_formatar_labels(labels)} {histograma['contagem']}")
+        return "\n".join(linhas) + "\n"
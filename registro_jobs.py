@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+"""
+Registro de jobs em segundo plano (SQLite) compartilhado pelos workers do gunicorn.
+
+Cada job é identificado pelo tipo (ex.: "analise", "historico") e pela chave das entradas.
+A reivindicação é feita numa transação exclusiva, de modo que, para a mesma chave, só um
+worker executa o cálculo e os demais reaproveitam o job: qualquer worker responde ao
+acompanhamento de progresso e entrega o resultado. O worker que executa o job atualiza
+periodicamente o progresso e o instante `atualizado_em`; um job em execução sem atualização
+há mais que o prazo informado é considerado abandonado (processo encerrado) e pode ser
+reivindicado de novo.
+"""
+import json
+import logging
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+STATUS_FINAIS = ("concluido", "erro")
+_COLUNAS = ("id", "tipo", "chave", "status", "criado_em", "iniciado_em", "concluido_em",
+            "atualizado_em", "progresso", "erro")
+
+
+class RegistroJobs:
+    def __init__(self, caminho, max_finalizados=20):
+        self.caminho = Path(caminho)
+        self.max_finalizados = max_finalizados
+        self._lock = threading.Lock()
+        self._inicializado = False
+
+    @contextmanager
+    def _conectar(self):
+        with self._lock:
+            if not self._inicializado:
+                self.caminho.parent.mkdir(parents=True, exist_ok=True)
+                conexao = sqlite3.connect(self.caminho, timeout=30)
+                conexao.execute("PRAGMA journal_mode=WAL")
+                conexao.execute(
+                    "CREATE TABLE IF NOT EXISTS jobs ("
+                    " id TEXT PRIMARY KEY, tipo TEXT NOT NULL, chave TEXT NOT NULL, status TEXT NOT NULL,"
+                    " criado_em REAL NOT NULL, iniciado_em REAL, concluido_em REAL, atualizado_em REAL NOT NULL,"
+                    " progresso TEXT, erro TEXT, resultado TEXT)"
+                )
+                conexao.execute("CREATE INDEX IF NOT EXISTS idx_jobs_chave ON jobs (tipo, chave)")
+                conexao.commit()
+                conexao.close()
+                self._inicializado = True
+        conexao = sqlite3.connect(self.caminho, timeout=30, isolation_level=None)
+        try:
+            yield conexao
+        finally:
+            conexao.close()
+
+    @staticmethod
+    def _para_dicionario(linha, resultado=None):
+        job = dict(zip(_COLUNAS, linha))
+        job["progresso"] = json.loads(job["progresso"]) if job["progresso"] else {}
+        if resultado is not None:
+            job["resultado"] = json.loads(resultado)
+        return job
+
+    def reivindicar(self, tipo, chave, validade, prazo_abandono, novo_job):
+        """
+        Devolve (job, False) se houver um job de `tipo`/`chave` em execução (atualizado há no máximo
+        `prazo_abandono` segundos) ou concluído há no máximo `validade` segundos; senão grava
+        `novo_job` (dicionário com id, status, progresso e, opcionalmente, resultado) e devolve
+        (novo_job, True). Jobs com erro nunca são reaproveitados.
+        """
+        agora = time.time()
+        with self._conectar() as conexao:
+            conexao.execute("BEGIN IMMEDIATE")
+            try:
+                linhas = conexao.execute(
+                    f"SELECT {', '.join(_COLUNAS)} FROM jobs WHERE tipo = ? AND chave = ? ORDER BY criado_em DESC",
+                    (tipo, chave),
+                ).fetchall()
+                for linha in linhas:
+                    job = self._para_dicionario(linha)
+                    if job["status"] not in STATUS_FINAIS and agora - job["atualizado_em"] <= prazo_abandono:
+                        conexao.execute("COMMIT")
+                        return job, False
+                    if job["status"] == "concluido" and agora - job["concluido_em"] <= validade:
+                        conexao.execute("COMMIT")
+                        return job, False
+                job = dict(novo_job, tipo=tipo, chave=chave, criado_em=agora, atualizado_em=agora)
+                conexao.execute(
+                    "INSERT INTO jobs (id, tipo, chave, status, criado_em, iniciado_em, concluido_em, atualizado_em,"
+                    " progresso, erro, resultado) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (job["id"], tipo, chave, job["status"], agora, job.get("iniciado_em"), job.get("concluido_em"),
+                     agora, json.dumps(job.get("progresso") or {}), job.get("erro"),
+                     None if job.get("resultado") is None else json.dumps(job["resultado"], ensure_ascii=False)),
+                )
+                self._descartar_antigos(conexao)
+                conexao.execute("COMMIT")
+            except BaseException:
+                conexao.execute("ROLLBACK")
+                raise
+        job.pop("resultado", None)
+        return job, True
+
+    def _descartar_antigos(self, conexao):
+        conexao.execute(
+            "DELETE FROM jobs WHERE id IN (SELECT id FROM jobs WHERE status IN ('concluido', 'erro')"
+            " ORDER BY concluido_em DESC LIMIT -1 OFFSET ?)",
+            (self.max_finalizados,),
+        )
+
+    def atualizar(self, job_id, **campos):
+        """Atualiza os campos informados (progresso e resultado são serializados) e o heartbeat."""
+        campos["atualizado_em"] = time.time()
+        if "progresso" in campos:
+            campos["progresso"] = json.dumps(campos["progresso"])
+        if "resultado" in campos:
+            campos["resultado"] = None if campos["resultado"] is None else json.dumps(campos["resultado"], ensure_ascii=False)
+        atribuicoes = ", ".join(f"{nome} = ?" for nome in campos)
+        try:
+            with self._conectar() as conexao:
+                conexao.execute(f"UPDATE jobs SET {atribuicoes} WHERE id = ?", (*campos.values(), job_id))
+        except sqlite3.Error as e:
+            logging.warning(f"Falha ao atualizar o job {job_id}: {e}")
+
+    def obter(self, job_id, com_resultado=False):
+        """Job pelo id (com "resultado" decodificado se `com_resultado`), ou None."""
+        colunas = ", ".join(_COLUNAS + (("resultado",) if com_resultado else ()))
+        with self._conectar() as conexao:
+            linha = conexao.execute(f"SELECT {colunas} FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if linha is None:
+            return None
+        if com_resultado:
+            return self._para_dicionario(linha[:-1], linha[-1] or "null")
+        return self._para_dicionario(linha)
@@ -8,18 +8,29 @@ Ela processa um histórico de 2 anos para garantir que os arquivos finais não e
 Lógica:
 1. Carrega o mapeamento de tickers.
 2. Para cada tipo de demonstrativo (DRE, BPA, etc.):
-   a. Cria um arquivo CSV final vazio, apenas com o cabeçalho.
-   b. Itera sobre cada ano, processando um de cada vez.
-   c. Dentro do ano, combina os dados CONSOLIDADOS e INDIVIDUAIS.
-   d. Anexa o resultado do ano ao arquivo CSV final.
-3. Ao final de tudo, apaga a pasta CVM_DATA para liberar espaço.
+   a. Planeja as partições (tipo, ano) a processar.
+   b. Pula os anos cujas fontes não mudaram desde a última execução (ver manifesto.json).
+   c. Processa as partições em sequência ou num pool de processos (--workers). Dentro do
+      ano, lê os CSVs em blocos filtrando CD_CVM e colunas, e combina os dados
+      CONSOLIDADOS e INDIVIDUAIS numa partição anual.
+   d. Concatena as partições anuais, em ordem de ano, no arquivo CSV final e grava ao lado
+      um <tipo>_consolidado.meta.json com separador, encoding e colunas, para leitura direta.
+   e. Grava uma cópia compacta em Arrow IPC (sem compressão) do CSV final, que a aplicação
+      abre por memory-map e cujas páginas são compartilhadas entre os workers.
+3. Ao final de tudo, apaga a pasta CVM_DATA para liberar espaço (exceto com --manter-zips).
+
+Uso: python update_data.py [--completo] [--manter-zips] [--workers N] [--historico-anos N]
 """
 import pandas as pd
 from pathlib import Path
+import argparse
+import hashlib
+import json
 import logging
 import time
 import sys
 from zipfile import ZipFile, BadZipFile
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 import shutil
 
@@ -30,6 +41,13 @@ BASE_DIR = Path(__file__).resolve().parent
 CAMINHO_MAPA_TICKER_CVM = BASE_DIR / "mapeamento_tickers.csv"
 DIRETORIO_DADOS_CVM = BASE_DIR / "CVM_DATA"
 DIRETORIO_DADOS_CONSOLIDADOS = BASE_DIR / "consolidated_data"
+DIRETORIO_PARTICOES = DIRETORIO_DADOS_CONSOLIDADOS / "particoes"
+CAMINHO_MANIFESTO = DIRETORIO_DADOS_CONSOLIDADOS / "manifesto.json"
+# Versão 2: partições passaram a conter apenas COLUNAS_UTILIZADAS
+VERSAO_MANIFESTO = 2
+# Colunas dos CSVs da CVM usadas pelo valuation; as demais são descartadas na leitura
+COLUNAS_UTILIZADAS = ['CD_CVM', 'DT_REFER', 'ORDEM_EXERC', 'CD_CONTA', 'VL_CONTA']
+TAMANHO_BLOCO_LEITURA = 200_000
 # AJUSTE FINAL: Reduzido para 2 anos para garantir a execução no PythonAnywhere.
 HISTORICO_ANOS_CVM = 2 
 
@@ -59,93 +77,324 @@ def carregar_mapeamento_robusto(caminho_arquivo):
         logging.error(f"ERRO CRÍTICO ao carregar o arquivo de mapeamento: {e}")
         return None
 
-def processar_e_anexar_por_tipo(tipo_demonstrativo, cvm_codes_filtrar, anos_a_processar):
+def ler_csv_filtrado(arquivo_zip, nome_csv, cvm_codes_filtrar):
     """
-    Processa os dados ano a ano e anexa a um arquivo CSV final para economizar disco.
+    Lê um CSV da CVM em blocos, mantendo apenas as COLUNAS_UTILIZADAS e as linhas cujo CD_CVM
+    está em `cvm_codes_filtrar`. O pico de memória fica limitado ao tamanho do bloco.
     """
-    logging.info(f"\n=== PROCESSANDO TIPO: {tipo_demonstrativo.upper()} ===")
-    caminho_salvar = DIRETORIO_DADOS_CONSOLIDADOS / f"{tipo_demonstrativo.lower()}_consolidado.csv"
-    
-    # Apaga o arquivo antigo para garantir que estamos começando do zero
-    if caminho_salvar.exists():
-        caminho_salvar.unlink()
+    blocos = []
+    with arquivo_zip.open(nome_csv) as csv_file:
+        leitor = pd.read_csv(csv_file, sep=';', encoding='latin-1', dtype=str,
+                             usecols=lambda coluna: coluna in COLUNAS_UTILIZADAS, chunksize=TAMANHO_BLOCO_LEITURA)
+        for bloco in leitor:
+            codigos = pd.to_numeric(bloco['CD_CVM'], errors='coerce')
+            manter = codigos.isin(cvm_codes_filtrar)
+            if manter.any():
+                bloco = bloco[manter].copy()
+                bloco['CD_CVM'] = codigos[manter].astype(int)
+                blocos.append(bloco)
+    if not blocos:
+        return pd.DataFrame()
+    return pd.concat(blocos, ignore_index=True)
+
+def processar_ano(tipo_demonstrativo, ano, caminho_zip, cvm_codes_filtrar):
+    """
+    Lê os dados CONSOLIDADOS e INDIVIDUAIS de um ano e aplica o fallback para o individual.
+    Retorna o DataFrame do ano (possivelmente vazio) ou None em caso de erro de leitura.
+    """
+    df_con_ano = pd.DataFrame()
+    df_ind_ano = pd.DataFrame()
+    encontrou_arquivo = False
+
+    try:
+        with ZipFile(caminho_zip, 'r') as z:
+            # Processa dados consolidados do ano
+            nome_csv_con = f'dfp_cia_aberta_{tipo_demonstrativo.upper()}_con_{ano}.csv'
+            if nome_csv_con in z.namelist():
+                encontrou_arquivo = True
+                df_con_ano = ler_csv_filtrado(z, nome_csv_con, cvm_codes_filtrar)
+            
+            # Processa dados individuais do ano, apenas para as empresas sem dados consolidados.
+            # O conjunto é fechado após ler o consolidado inteiro, então vale entre blocos.
+            nome_csv_ind = f'dfp_cia_aberta_{tipo_demonstrativo.upper()}_ind_{ano}.csv'
+            if nome_csv_ind in z.namelist():
+                encontrou_arquivo = True
+                cvm_em_con = set(df_con_ano['CD_CVM'].unique()) if not df_con_ano.empty else set()
+                df_ind_ano = ler_csv_filtrado(z, nome_csv_ind, set(cvm_codes_filtrar) - cvm_em_con)
+
+    except Exception as e:
+        logging.error(f"  ✗ ERRO inesperado ao processar {caminho_zip.name}: {e}")
+        return None
+
+    if not encontrou_arquivo:
+        logging.warning(f"  -> Nenhum dado (con ou ind) encontrado para {tipo_demonstrativo.upper()} em {ano}.")
+        return pd.DataFrame()
+
+    return pd.concat([df_con_ano, df_ind_ano], ignore_index=True)
+
+def calcular_hash_mapeamento(cvm_codes_filtrar):
+    """Hash do conjunto de códigos CVM filtrados (uma mudança no mapa invalida as partições)."""
+    codigos = ",".join(str(codigo) for codigo in sorted(cvm_codes_filtrar))
+    return hashlib.sha256(codigos.encode()).hexdigest()
+
+def calcular_hash_fontes(tipo_demonstrativo, ano, caminho_zip):
+    """
+    Impressão digital do conteúdo dos CSVs (con/ind) do tipo e ano dentro do ZIP.
+    Usa o CRC-32 e o tamanho descompactado registrados no próprio ZIP, sem descompactá-lo.
+    """
+    nomes = {
+        f'dfp_cia_aberta_{tipo_demonstrativo.upper()}_con_{ano}.csv',
+        f'dfp_cia_aberta_{tipo_demonstrativo.upper()}_ind_{ano}.csv',
+    }
+    with ZipFile(caminho_zip, 'r') as z:
+        return {
+            info.filename: f"crc32:{info.CRC:08x}:{info.file_size}"
+            for info in z.infolist() if info.filename in nomes
+        }
+
+def carregar_manifesto():
+    if not CAMINHO_MANIFESTO.exists():
+        return {"versao": VERSAO_MANIFESTO, "particoes": {}}
+    try:
+        manifesto = json.loads(CAMINHO_MANIFESTO.read_text(encoding='utf-8'))
+        if manifesto.get("versao") != VERSAO_MANIFESTO:
+            logging.info("Manifesto em versão diferente; todas as partições serão reprocessadas.")
+            return {"versao": VERSAO_MANIFESTO, "particoes": {}}
+        return manifesto
+    except Exception as e:
+        logging.warning(f"Manifesto ilegível ({e}); todas as partições serão reprocessadas.")
+        return {"versao": VERSAO_MANIFESTO, "particoes": {}}
+
+def salvar_manifesto(manifesto):
+    caminho_temp = CAMINHO_MANIFESTO.with_suffix('.tmp')
+    caminho_temp.write_text(json.dumps(manifesto, indent=2, ensure_ascii=False), encoding='utf-8')
+    caminho_temp.replace(CAMINHO_MANIFESTO)
 
+def montar_arquivo_consolidado(caminho_salvar, particoes):
+    """Concatena as partições anuais (já em CSV) no arquivo final, escrevendo o cabeçalho uma única vez."""
     cabecalho_escrito = False
+    with open(caminho_salvar, 'wb') as destino:
+        for particao in particoes:
+            with open(particao, 'rb') as origem:
+                cabecalho = origem.readline()
+                if not cabecalho_escrito:
+                    destino.write(cabecalho)
+                    cabecalho_escrito = True
+                shutil.copyfileobj(origem, destino)
+    return cabecalho_escrito
+
+def salvar_metadados_csv(caminho_csv, sep=',', encoding='utf-8'):
+    """
+    Grava o formato do CSV consolidado (separador, encoding, colunas e tamanho) ao lado dele,
+    para que a aplicação leia o arquivo numa única passada, sem tentar adivinhar o formato.
+    """
+    caminho_metadados = caminho_csv.with_suffix('.meta.json')
+    with open(caminho_csv, 'r', encoding=encoding) as arquivo:
+        colunas = arquivo.readline().rstrip('\r\n').split(sep)
+    metadados = {
+        "sep": sep, "encoding": encoding, "colunas": colunas,
+        "tamanho_bytes": caminho_csv.stat().st_size,
+    }
+    caminho_temp = caminho_metadados.with_suffix('.tmp')
+    caminho_temp.write_text(json.dumps(metadados, ensure_ascii=False), encoding='utf-8')
+    caminho_temp.replace(caminho_metadados)
+
+def planejar_particoes_por_tipo(tipo_demonstrativo, cvm_codes_filtrar, anos_a_processar, manifesto, completo=False):
+    """
+    Decide quais anos do tipo precisam ser (re)processados.
+
+    Só entram os anos cujo conteúdo de origem (ou o mapeamento de tickers) mudou desde a
+    última execução, conforme registrado no manifesto. Com `completo=True` todos os anos
+    disponíveis entram. Retorna (tarefas, houve_alteracao).
+    """
+    logging.info(f"\n=== PLANEJANDO TIPO: {tipo_demonstrativo.upper()} ===")
+    caminho_salvar = DIRETORIO_DADOS_CONSOLIDADOS / f"{tipo_demonstrativo.lower()}_consolidado.csv"
+    registros = manifesto["particoes"].setdefault(tipo_demonstrativo.upper(), {})
+    hash_mapeamento = calcular_hash_mapeamento(cvm_codes_filtrar)
+    houve_alteracao = not caminho_salvar.exists()
+    tarefas = []
+
+    # Descarta partições de anos que saíram da janela de histórico
+    for ano_registrado in [a for a in registros if int(a) not in anos_a_processar]:
+        (DIRETORIO_PARTICOES / registros.pop(ano_registrado)["arquivo"]).unlink(missing_ok=True)
+        houve_alteracao = True
 
     for ano in anos_a_processar:
         nome_zip = f'dfp_cia_aberta_{ano}.zip'
         caminho_zip = DIRETORIO_DADOS_CVM / nome_zip
+        caminho_particao = DIRETORIO_PARTICOES / f"{tipo_demonstrativo.lower()}_{ano}.csv"
+        registro = registros.get(str(ano))
         
         if not caminho_zip.exists():
-            logging.warning(f"--- Pulando ano {ano}: Arquivo '{nome_zip}' não encontrado. ---")
+            if registro and (registro["linhas"] == 0 or caminho_particao.exists()):
+                logging.info(f"--- Ano {ano}: '{nome_zip}' ausente; mantendo a partição já processada. ---")
+            else:
+                logging.warning(f"--- Pulando ano {ano}: Arquivo '{nome_zip}' não encontrado. ---")
             continue
-            
-        logging.info(f"--- Processando ano {ano} do arquivo '{nome_zip}' ---")
-        
-        df_con_ano = pd.DataFrame()
-        df_ind_ano = pd.DataFrame()
 
         try:
-            with ZipFile(caminho_zip, 'r') as z:
-                # Processa dados consolidados do ano
-                nome_csv_con = f'dfp_cia_aberta_{tipo_demonstrativo.upper()}_con_{ano}.csv'
-                if nome_csv_con in z.namelist():
-                    with z.open(nome_csv_con) as csv_file:
-                        df_con_ano = pd.read_csv(csv_file, sep=';', encoding='latin-1', low_memory=False, dtype=str)
-                
-                # Processa dados individuais do ano
-                nome_csv_ind = f'dfp_cia_aberta_{tipo_demonstrativo.upper()}_ind_{ano}.csv'
-                if nome_csv_ind in z.namelist():
-                    with z.open(nome_csv_ind) as csv_file:
-                        df_ind_ano = pd.read_csv(csv_file, sep=';', encoding='latin-1', low_memory=False, dtype=str)
-
-        except Exception as e:
-            logging.error(f"  ✗ ERRO inesperado ao processar {nome_zip}: {e}")
+            hash_fontes = calcular_hash_fontes(tipo_demonstrativo, ano, caminho_zip)
+        except (BadZipFile, OSError) as e:
+            logging.error(f"  ✗ ERRO ao ler o índice de {nome_zip}: {e}")
             continue
 
-        if df_con_ano.empty and df_ind_ano.empty:
-            logging.warning(f"  -> Nenhum dado (con ou ind) encontrado para {tipo_demonstrativo.upper()} em {ano}.")
+        inalterado = (
+            registro is not None
+            and registro["hash_fontes"] == hash_fontes
+            and registro["hash_mapeamento"] == hash_mapeamento
+            and (registro["linhas"] == 0 or caminho_particao.exists())
+        )
+        if inalterado and not completo:
+            logging.info(f"--- Ano {ano}: fontes inalteradas, partição reaproveitada. ---")
             continue
 
-        if not df_con_ano.empty:
-            df_con_ano['CD_CVM'] = pd.to_numeric(df_con_ano['CD_CVM'], errors='coerce').dropna().astype(int)
-            df_con_ano = df_con_ano[df_con_ano['CD_CVM'].isin(cvm_codes_filtrar)].copy()
-        
-        if not df_ind_ano.empty:
-            df_ind_ano['CD_CVM'] = pd.to_numeric(df_ind_ano['CD_CVM'], errors='coerce').dropna().astype(int)
-            df_ind_ano = df_ind_ano[df_ind_ano['CD_CVM'].isin(cvm_codes_filtrar)].copy()
+        tarefas.append({
+            "tipo": tipo_demonstrativo, "ano": ano, "caminho_zip": caminho_zip,
+            "caminho_particao": caminho_particao, "hash_fontes": hash_fontes,
+            "hash_mapeamento": hash_mapeamento,
+        })
 
-        cvm_em_con = set(df_con_ano['CD_CVM'].unique()) if not df_con_ano.empty else set()
-        df_ind_fallback = df_ind_ano[~df_ind_ano['CD_CVM'].isin(cvm_em_con)] if not df_ind_ano.empty else pd.DataFrame()
-        
-        df_final_ano = pd.concat([df_con_ano, df_ind_fallback], ignore_index=True)
+    return tarefas, houve_alteracao
+
+def processar_particao(tipo_demonstrativo, ano, caminho_zip, caminho_particao, cvm_codes_filtrar):
+    """
+    Processa um (tipo, ano) e grava sua partição. Executada nos processos do pool.
+    Retorna o número de linhas gravadas ou None em caso de erro.
+    """
+    logging.info(f"--- Processando {tipo_demonstrativo.upper()} {ano} do arquivo '{caminho_zip.name}' ---")
+    df_final_ano = processar_ano(tipo_demonstrativo, ano, caminho_zip, cvm_codes_filtrar)
+    if df_final_ano is None:
+        return None
 
+    try:
         if df_final_ano.empty:
-            continue
+            caminho_particao.unlink(missing_ok=True)
+        else:
+            caminho_temp = caminho_particao.with_suffix('.tmp')
+            df_final_ano.to_csv(caminho_temp, index=False, encoding='utf-8', sep=',')
+            caminho_temp.replace(caminho_particao)
+        logging.info(f"  -> Partição de {ano} para {tipo_demonstrativo.upper()} gravada ({len(df_final_ano)} linhas).")
+        return len(df_final_ano)
 
-        try:
-            mode = 'a' if cabecalho_escrito else 'w'
-            header = not cabecalho_escrito
-            df_final_ano.to_csv(caminho_salvar, index=False, encoding='utf-8', sep=',', mode=mode, header=header)
-            if not cabecalho_escrito:
-                cabecalho_escrito = True
-            
-            logging.info(f"  -> Dados de {ano} para {tipo_demonstrativo.upper()} anexados com sucesso.")
+    except Exception as e:
+        logging.error(f"✗ ERRO CRÍTICO ao gravar a partição de {ano} para {tipo_demonstrativo.lower()}: {e}")
+        return None
 
-        except Exception as e:
-            logging.error(f"✗ ERRO CRÍTICO ao anexar dados para {tipo_demonstrativo.lower()}: {e}")
-            return False
+def executar_tarefas(tarefas, cvm_codes_filtrar, workers=1):
+    """
+    Executa as tarefas de partição, em sequência ou num pool de processos.
+    Os resultados (linhas ou None) são devolvidos na mesma ordem das tarefas.
+    """
+    argumentos = [
+        (t["tipo"], t["ano"], t["caminho_zip"], t["caminho_particao"], cvm_codes_filtrar) for t in tarefas
+    ]
+    if workers <= 1 or len(tarefas) <= 1:
+        return [processar_particao(*args) for args in argumentos]
+
+    resultados = []
+    with ProcessPoolExecutor(max_workers=min(workers, len(tarefas))) as executor:
+        futuros = [executor.submit(processar_particao, *args) for args in argumentos]
+        for tarefa, futuro in zip(tarefas, futuros):
+            try:
+                resultados.append(futuro.result())
+            except Exception as e:
+                logging.error(f"✗ ERRO no processamento de {tarefa['tipo']} {tarefa['ano']}: {e}")
+                resultados.append(None)
+    return resultados
 
-    if not cabecalho_escrito:
+def finalizar_tipo(tipo_demonstrativo, anos_a_processar, manifesto, houve_alteracao, houve_falha):
+    """Monta o CSV final do tipo concatenando as partições em ordem de ano."""
+    caminho_salvar = DIRETORIO_DADOS_CONSOLIDADOS / f"{tipo_demonstrativo.lower()}_consolidado.csv"
+    registros = manifesto["particoes"].get(tipo_demonstrativo.upper(), {})
+    particoes = [
+        DIRETORIO_PARTICOES / registros[str(ano)]["arquivo"] for ano in anos_a_processar
+        if str(ano) in registros and registros[str(ano)]["linhas"] > 0
+    ]
+    if not particoes:
         logging.warning(f"✗ Nenhum dado foi processado ou salvo para {tipo_demonstrativo.upper()}.")
         pd.DataFrame().to_csv(caminho_salvar, index=False)
+        caminho_salvar.with_suffix('.arrow').unlink(missing_ok=True)
+        caminho_salvar.with_suffix('.meta.json').unlink(missing_ok=True)
+        return False
+
+    if houve_alteracao:
+        try:
+            montar_arquivo_consolidado(caminho_salvar, particoes)
+            salvar_metadados_csv(caminho_salvar)
+        except Exception as e:
+            logging.error(f"✗ ERRO CRÍTICO ao montar '{caminho_salvar.name}': {e}")
+            return False
+        salvar_formato_colunar(caminho_salvar)
+        logging.info(f"✓ Arquivo final para {tipo_demonstrativo.upper()} gerado com sucesso em '{caminho_salvar.name}'.")
+    else:
+        logging.info(f"✓ {tipo_demonstrativo.upper()} sem alterações; '{caminho_salvar.name}' mantido.")
+        gerar_copias_ausentes(caminho_salvar)
+    return not houve_falha
+
+def gerar_copias_ausentes(caminho_csv):
+    """
+    Regera o .meta.json e a cópia .arrow de um CSV consolidado que não mudou quando eles faltam
+    ou são mais antigos que o CSV (instalações anteriores a esses arquivos, ou arquivos apagados).
+    """
+    mtime_csv = caminho_csv.stat().st_mtime_ns
+
+    def desatualizado(caminho):
+        return not caminho.exists() or caminho.stat().st_mtime_ns < mtime_csv
+
+    if desatualizado(caminho_csv.with_suffix('.meta.json')):
+        try:
+            salvar_metadados_csv(caminho_csv)
+        except Exception as e:
+            logging.warning(f"  -> Não foi possível gerar os metadados de '{caminho_csv.name}': {e}")
+    if desatualizado(caminho_csv.with_suffix('.arrow')) or caminho_csv.with_suffix('.parquet').exists():
+        salvar_formato_colunar(caminho_csv)
+
+def salvar_formato_colunar(caminho_csv):
+    """
+    Grava uma cópia compacta do CSV consolidado em Arrow IPC (Feather v2) sem compressão,
+    preferida pela aplicação web, que a abre por memory-map. Só entram as COLUNAS_UTILIZADAS:
+    CD_CVM como int32, DT_REFER como data, CD_CONTA e ORDEM_EXERC categóricos e VL_CONTA
+    float64, num único bloco para que as colunas numéricas sejam lidas sem cópia.
+    Em caso de falha, remove a cópia antiga para que a aplicação volte a ler o CSV.
+    """
+    caminho_arrow = caminho_csv.with_suffix('.arrow')
+    # Cópia Parquet das versões anteriores, que não é mais lida pela aplicação
+    caminho_csv.with_suffix('.parquet').unlink(missing_ok=True)
+    try:
+        df = pd.read_csv(caminho_csv, sep=',', encoding='utf-8', usecols=COLUNAS_UTILIZADAS,
+                         dtype={'CD_CONTA': str, 'ORDEM_EXERC': str, 'DT_REFER': str})
+        df['CD_CVM'] = pd.to_numeric(df['CD_CVM'], errors='coerce')
+        df = df.dropna(subset=['CD_CVM']).reset_index(drop=True)
+        df['CD_CVM'] = df['CD_CVM'].astype('int32')
+        df['VL_CONTA'] = pd.to_numeric(df['VL_CONTA'], errors='coerce').astype('float64')
+        df['DT_REFER'] = pd.to_datetime(df['DT_REFER'], errors='coerce')
+        for coluna in ['CD_CONTA', 'ORDEM_EXERC']:
+            df[coluna] = df[coluna].astype('category')
+        # Grava num arquivo temporário e troca atomicamente: os workers que ainda mapeiam a
+        # versão anterior continuam lendo o arquivo antigo até recarregarem.
+        caminho_temp = caminho_arrow.with_suffix('.tmp')
+        df.to_feather(caminho_temp, compression='uncompressed', chunksize=max(len(df), 1))
+        caminho_temp.replace(caminho_arrow)
+        logging.info(f"  -> Cópia colunar gerada em '{caminho_arrow.name}'.")
+        return True
+    except Exception as e:
+        logging.warning(f"  -> Não foi possível gerar '{caminho_arrow.name}' (a aplicação usará o CSV): {e}")
+        caminho_arrow.unlink(missing_ok=True)
         return False
 
-    logging.info(f"✓ Arquivo final para {tipo_demonstrativo.upper()} gerado com sucesso em '{caminho_salvar.name}'.")
-    return True
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Atualiza os demonstrativos consolidados da CVM.")
+    parser.add_argument("--completo", action="store_true",
+                        help="Reprocessa todos os anos, ignorando o manifesto de atualização incremental.")
+    parser.add_argument("--manter-zips", action="store_true",
+                        help="Não apaga a pasta CVM_DATA ao final.")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Número de processos para processar as partições (tipo, ano) em paralelo.")
+    parser.add_argument("--historico-anos", type=int, default=HISTORICO_ANOS_CVM,
+                        help=f"Anos de histórico a processar além do ano atual (padrão: {HISTORICO_ANOS_CVM}).")
+    args = parser.parse_args(argv)
 
-def main():
-    print(f"CVM DATA UPDATER (Otimizado para {HISTORICO_ANOS_CVM} Anos de Histórico)")
+    print(f"CVM DATA UPDATER (Otimizado para {args.historico_anos} Anos de Histórico)")
     print("=" * 60)
 
     cvm_codes_filtrar = carregar_mapeamento_robusto(CAMINHO_MAPA_TICKER_CVM)
@@ -155,25 +404,52 @@ def main():
     DIRETORIO_DADOS_CONSOLIDADOS.mkdir(exist_ok=True)
 
     ano_atual = datetime.today().year
-    anos_a_processar = range(ano_atual - HISTORICO_ANOS_CVM, ano_atual + 1)
+    anos_a_processar = range(ano_atual - args.historico_anos, ano_atual + 1)
     print(f"\n1. Processando arquivos ZIP locais para o período de {min(anos_a_processar)} a {max(anos_a_processar)}...")
 
     if not DIRETORIO_DADOS_CVM.exists():
         logging.error(f"ERRO: O diretório '{DIRETORIO_DADOS_CVM.name}' não foi encontrado. Crie-o e coloque os arquivos .zip dentro dele.")
         return False
 
+    manifesto = carregar_manifesto()
+    DIRETORIO_PARTICOES.mkdir(parents=True, exist_ok=True)
     tipos_demonstrativos = ['DRE', 'BPA', 'BPP', 'DFC_MI']
+    tarefas, alterados = [], {}
+    for tipo in tipos_demonstrativos:
+        tarefas_tipo, alterados[tipo] = planejar_particoes_por_tipo(
+            tipo, cvm_codes_filtrar, anos_a_processar, manifesto, completo=args.completo)
+        tarefas.extend(tarefas_tipo)
+
+    logging.info(f"{len(tarefas)} partições (tipo, ano) a processar com {args.workers} worker(s).")
+    falhas = set()
+    for tarefa, linhas in zip(tarefas, executar_tarefas(tarefas, cvm_codes_filtrar, args.workers)):
+        if linhas is None:
+            falhas.add(tarefa["tipo"])
+            continue
+        manifesto["particoes"][tarefa["tipo"].upper()][str(tarefa["ano"])] = {
+            "arquivo": tarefa["caminho_particao"].name,
+            "hash_fontes": tarefa["hash_fontes"],
+            "hash_mapeamento": tarefa["hash_mapeamento"],
+            "linhas": linhas,
+            "processado_em": datetime.now().isoformat(timespec='seconds'),
+        }
+        alterados[tarefa["tipo"]] = True
+    salvar_manifesto(manifesto)
+
     sucessos = 0
     for tipo in tipos_demonstrativos:
-        if processar_e_anexar_por_tipo(tipo, cvm_codes_filtrar, anos_a_processar):
+        if finalizar_tipo(tipo, anos_a_processar, manifesto, alterados[tipo], tipo in falhas):
             sucessos += 1
     
     print("\n2. Limpando arquivos ZIP temporários...")
-    try:
-        shutil.rmtree(DIRETORIO_DADOS_CVM)
-        print(f"✓ Diretório de dados temporários '{DIRETORIO_DADOS_CVM.name}' removido com sucesso.")
-    except Exception as e:
-        print(f"✗ Erro ao limpar diretório temporário: {e}")
+    if args.manter_zips:
+        print(f"✓ Diretório '{DIRETORIO_DADOS_CVM.name}' mantido (--manter-zips).")
+    else:
+        try:
+            shutil.rmtree(DIRETORIO_DADOS_CVM)
+            print(f"✓ Diretório de dados temporários '{DIRETORIO_DADOS_CVM.name}' removido com sucesso.")
+        except Exception as e:
+            print(f"✗ Erro ao limpar diretório temporário: {e}")
 
     print("\n" + "=" * 60)
     if sucessos == len(tipos_demonstrativos):